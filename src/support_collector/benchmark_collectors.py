@@ -0,0 +1,501 @@
+import argparse
+import importlib
+import io
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+from urllib.parse import unquote, urlparse
+from botocore.awsrequest import AWSResponse
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "support-collector-lambda")
+BUCKET_NAME = "support-collector-benchmark"
+ACCOUNT_ID = "111122223333"
+COLLECTORS = ("cases", "health", "ta")
+
+# The collectors only read back these prefixes, the other objects are counted but not kept
+STORED_PREFIXES = ("sync-state/", "partitions/")
+# Number of communications embedded in a case by DescribeCases
+RECENT_COMMUNICATIONS = 5
+UNLIMITED_RATE = 1000000
+
+
+class RawBody(io.BytesIO):
+    """Body of a synthetic HTTP response, as read by botocore."""
+
+    def stream(self, **_kwargs):
+        contents = self.read()
+        while contents:
+            yield contents
+            contents = self.read()
+
+
+class SyntheticAws:
+    """
+    In-process stand-in for the Support, Health and S3 APIs. It answers the
+    requests of the botocore clients from synthetic data instead of sending
+    them, so the collectors run their real serialization, parsing, retry and
+    rate limiting code paths.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.started = datetime.now(timezone.utc)
+        self.calls = {}
+        self.bytes_written = 0
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.handlers = {
+            "support.DescribeCases": self.describe_cases,
+            "support.DescribeCommunications": self.describe_communications,
+            "support.DescribeTrustedAdvisorChecks": self.describe_trusted_advisor_checks,
+            "support.DescribeTrustedAdvisorCheckResult": self.describe_trusted_advisor_check_result,
+            "health.DescribeEvents": self.describe_events,
+            "health.DescribeEventDetails": self.describe_event_details,
+        }
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.bytes_written = 0
+
+    def handle(self, request, event_name, **_kwargs):
+        """The before-send handler of the clients: the returned response replaces the HTTP call."""
+        _, service, operation = event_name.split(".", 2)
+        api = f"{service}.{operation}"
+        with self.lock:
+            self.calls[api] = self.calls.get(api, 0) + 1
+        if self.options.latency_ms:
+            time.sleep(self.options.latency_ms / 1000)
+
+        if service == "s3":
+            return self.s3_response(request, operation)
+
+        if api not in self.handlers:
+            raise NotImplementedError(f"{api} is not simulated")
+        body = json.loads(request.body or b"{}")
+        return json_response(request.url, self.handlers[api](body))
+
+    # Support API
+
+    def case_time(self, case_index):
+        return self.started - timedelta(minutes=case_index)
+
+    def communication(self, case_index, communication_index):
+        time_created = self.case_time(case_index) + timedelta(minutes=communication_index)
+        return {
+            "caseId": f"case-{ACCOUNT_ID}-{case_index}",
+            "body": f"Communication {communication_index} of case {case_index}. " * 8,
+            "submittedBy": "customer@example.com",
+            "timeCreated": iso_time(time_created),
+            "attachmentSet": [],
+        }
+
+    def case(self, case_index):
+        count = self.options.communications
+        recent = {
+            "communications": [
+                self.communication(case_index, i)
+                for i in range(count - 1, max(count - RECENT_COMMUNICATIONS, 0) - 1, -1)
+            ]
+        }
+        if count > RECENT_COMMUNICATIONS:
+            recent["nextToken"] = "recent"
+        return {
+            "caseId": f"case-{ACCOUNT_ID}-{case_index}",
+            "displayId": str(100000 + case_index),
+            "subject": f"Synthetic case {case_index}",
+            "status": "resolved",
+            "serviceCode": "amazon-elastic-compute-cloud-linux",
+            "categoryCode": "other",
+            "severityCode": "low",
+            "submittedBy": "customer@example.com",
+            "timeCreated": iso_time(self.case_time(case_index)),
+            "recentCommunications": recent,
+            "ccEmailAddresses": [],
+            "language": "en",
+        }
+
+    def describe_cases(self, body):
+        if body.get("displayId"):
+            return {"cases": [self.case(int(body["displayId"]) - 100000)]}
+        start, end, token = page_range(body, self.options.cases, self.options.page_size)
+        return {"cases": [self.case(i) for i in range(start, end)], **token}
+
+    def describe_communications(self, body):
+        case_index = int(body["caseId"].rsplit("-", 1)[1])
+        communications = [
+            self.communication(case_index, i)
+            for i in range(self.options.communications - 1, -1, -1)
+        ]
+        if body.get("afterTime"):
+            communications = [c for c in communications if c["timeCreated"] > body["afterTime"]]
+        start, end, token = page_range(body, len(communications), self.options.page_size)
+        return {"communications": communications[start:end], **token}
+
+    def check_ids(self):
+        ta = importlib.import_module("upload_ta")
+        check_ids = sorted(ta.load_check_descriptions())[: self.options.ta_checks]
+        check_ids += [f"synthetic{i}" for i in range(self.options.ta_checks - len(check_ids))]
+        return check_ids
+
+    def describe_trusted_advisor_checks(self, _body):
+        return {
+            "checks": [
+                {
+                    "id": check_id,
+                    "name": f"Check {check_id}",
+                    "description": "",
+                    "category": "security",
+                    "metadata": ["Region", "Resource ID", "Status"],
+                }
+                for check_id in self.check_ids()
+            ]
+        }
+
+    def describe_trusted_advisor_check_result(self, body):
+        flagged_resources = [
+            {
+                "status": "warning",
+                "region": "us-east-1",
+                "resourceId": f"resource-{i}",
+                "isSuppressed": False,
+                "metadata": ["us-east-1", f"resource-{i}", "Yellow"],
+            }
+            for i in range(self.options.flagged_resources)
+        ]
+        return {
+            "result": {
+                "checkId": body["checkId"],
+                "timestamp": iso_time(self.started),
+                "status": "warning" if flagged_resources else "ok",
+                "resourcesSummary": {
+                    "resourcesProcessed": len(flagged_resources),
+                    "resourcesFlagged": len(flagged_resources),
+                    "resourcesIgnored": 0,
+                    "resourcesSuppressed": 0,
+                },
+                "categorySpecificSummary": {},
+                "flaggedResources": flagged_resources,
+            }
+        }
+
+    # Health API
+
+    def event_arn(self, event_index):
+        return f"arn:aws:health:us-east-1::event/EC2/AWS_EC2_OPERATIONAL_ISSUE/AWS_EC2_OPERATIONAL_ISSUE_{event_index}"
+
+    def describe_events(self, body):
+        start, end, token = page_range(body, self.options.health_events, self.options.page_size)
+        events = []
+        for i in range(start, end):
+            event_time = (self.started - timedelta(hours=i)).timestamp()
+            events.append(
+                {
+                    "arn": self.event_arn(i),
+                    "service": "EC2",
+                    "eventTypeCode": "AWS_EC2_OPERATIONAL_ISSUE",
+                    "eventTypeCategory": "issue",
+                    "region": "us-east-1",
+                    "startTime": event_time,
+                    "lastUpdatedTime": event_time,
+                    "statusCode": "closed",
+                    "eventScopeCode": "PUBLIC",
+                }
+            )
+        return {"events": events, **token}
+
+    def describe_event_details(self, body):
+        return {
+            "successfulSet": [
+                {
+                    "event": {"arn": arn},
+                    "eventDescription": {"latestDescription": f"Description of {arn}. " * 20},
+                }
+                for arn in body["eventArns"]
+            ],
+            "failedSet": [],
+        }
+
+    # S3
+
+    def s3_response(self, request, operation):
+        url = urlparse(request.url)
+        key = unquote(url.path.lstrip("/"))
+        if not url.netloc.startswith(BUCKET_NAME):
+            key = key.split("/", 1)[1]
+
+        if operation == "PutObject":
+            body = request.body or b""
+            if not isinstance(body, bytes):
+                body = body.read()
+            with self.lock:
+                self.bytes_written += len(body)
+                if key.startswith(STORED_PREFIXES):
+                    self.objects[key] = body
+            return AWSResponse(request.url, 200, {"ETag": '"synthetic"'}, RawBody(b""))
+
+        if operation == "GetObject":
+            with self.lock:
+                body = self.objects.get(key)
+            if body is None:
+                error = b"<Error><Code>NoSuchKey</Code><Message>The specified key does not exist.</Message></Error>"
+                return AWSResponse(request.url, 404, {"Content-Type": "application/xml"}, RawBody(error))
+            return AWSResponse(request.url, 200, {"Content-Length": str(len(body))}, RawBody(body))
+
+        raise NotImplementedError(f"s3.{operation} is not simulated")
+
+
+def iso_time(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%S.") + f"{value.microsecond // 1000:03d}Z"
+
+
+def page_range(body, total, page_size):
+    """Get the items of the page requested by a nextToken, and the token of the next page."""
+    start = int(body.get("nextToken", "page-0").split("-")[1])
+    end = min(total, start + page_size)
+    return start, end, ({"nextToken": f"page-{end}"} if end < total else {})
+
+
+def json_response(url, data):
+    body = json.dumps(data).encode("utf-8")
+    return AWSResponse(url, 200, {"Content-Type": "application/x-amz-json-1.1"}, RawBody(body))
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the process, on Linux."""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """
+    Get the peak resident set size in bytes since the last reset on Linux,
+    or since the start of the process elsewhere.
+    """
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def setup_environment(storage_dir=None):
+    """Configure boto3 to never reach AWS, before the Lambda modules create their session."""
+    if storage_dir:
+        # Read by the storage module when it is imported
+        os.environ["LOCAL_STORAGE_DIR"] = storage_dir
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    # Keep the request bodies plain bytes, as the synthetic S3 reads them
+    os.environ["AWS_REQUEST_CHECKSUM_CALCULATION"] = "when_required"
+    os.environ["AWS_RESPONSE_CHECKSUM_VALIDATION"] = "when_required"
+    sys.path.insert(0, LAMBDA_DIR)
+
+
+def count_local_writes(storage, synthetic_aws):
+    """Count the bytes written to the local directory, like the S3 uploads."""
+    put = storage.LocalSink.put
+
+    def counting_put(sink, key, body, extra_args=None):
+        with synthetic_aws.lock:
+            synthetic_aws.bytes_written += len(body)
+        return put(sink, key, body, extra_args)
+
+    storage.LocalSink.put = counting_put
+
+
+def run_collector(collector, options, synthetic_aws):
+    """Run a collector from a clean state and measure it."""
+    synthetic_aws.reset()
+    if collector == "cases":
+        upload_cases = importlib.import_module("upload_cases")
+
+        def collect():
+            return upload_cases.upload_all_cases_to_s3(
+                BUCKET_NAME,
+                options.days,
+                ACCOUNT_ID,
+                options.upload_concurrency,
+                incremental=False,
+                output_format=options.output_format,
+            )
+
+    elif collector == "health":
+        upload_health = importlib.import_module("upload_health")
+
+        def collect():
+            return upload_health.upload_health_events_to_s3(
+                BUCKET_NAME,
+                options.days,
+                ACCOUNT_ID,
+                options.upload_concurrency,
+                incremental=False,
+                output_format=options.output_format,
+            )
+
+    else:
+        upload_ta = importlib.import_module("upload_ta")
+
+        def collect():
+            return upload_ta.upload_all_recommendations_to_s3(
+                BUCKET_NAME,
+                ACCOUNT_ID,
+                options.upload_concurrency,
+                output_format=options.output_format,
+            )
+
+    reset_peak_rss()
+    if options.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        if options.verbose:
+            report = collect()
+        else:
+            with redirect_stdout(devnull):
+                report = collect()
+    wall_time = time.perf_counter() - started
+    result = {
+        "collector": collector,
+        "wall_time_seconds": round(wall_time, 3),
+        "documents_uploaded": len(report["succeeded"]),
+        "documents_failed": len(report["failed"]),
+        "api_calls": dict(sorted(synthetic_aws.calls.items())),
+        "total_api_calls": sum(synthetic_aws.calls.values()),
+        "bytes_written": synthetic_aws.bytes_written,
+        "peak_rss_bytes": peak_rss(),
+    }
+    if options.trace_memory:
+        result["peak_traced_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def print_result(result):
+    print(
+        f"{result['collector']:>6}: {result['wall_time_seconds']:.3f}s, "
+        f"{result['documents_uploaded']} uploaded, {result['documents_failed']} failed, "
+        f"{result['total_api_calls']} API calls, "
+        f"{result['bytes_written'] / 1024 / 1024:.1f} MiB written, "
+        f"peak RSS {result['peak_rss_bytes'] / 1024 / 1024:.1f} MiB"
+    )
+    if "peak_traced_memory_bytes" in result:
+        print(f"        peak Python heap: {result['peak_traced_memory_bytes'] / 1024 / 1024:.1f} MiB")
+    for api, count in result["api_calls"].items():
+        print(f"        {api}: {count}")
+
+
+def main(options):
+    setup_environment(options.storage_dir)
+    clients = importlib.import_module("clients")
+    health_client = importlib.import_module("health_client")
+    rate_limiter = importlib.import_module("rate_limiter")
+
+    synthetic_aws = SyntheticAws(options)
+    clients.session.events.register("before-send", synthetic_aws.handle)
+    # The Health API region is fixed instead of resolved with DNS
+    health_client.active_region_with_ttl = lambda: ("us-east-1", 3600)
+    if options.storage_dir:
+        count_local_writes(importlib.import_module("storage"), synthetic_aws)
+    rate_limiter.ApiRateLimits.configure(
+        options.api_rates
+        or {api: UNLIMITED_RATE for api in rate_limiter.DEFAULT_API_RATES}
+    )
+
+    results = []
+    for collector in options.collectors:
+        result = run_collector(collector, options, synthetic_aws)
+        print_result(result)
+        results.append(result)
+
+    summary = {
+        "options": {key: value for key, value in vars(options).items() if key != "output"},
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Wrote the results to {options.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the collectors offline against synthetic Support, Health and S3 APIs"
+    )
+    parser.add_argument(
+        "--collectors",
+        nargs="+",
+        choices=COLLECTORS,
+        default=list(COLLECTORS),
+        help="Collectors to run, in order",
+    )
+    parser.add_argument("--cases", type=int, default=10000, help="Number of support cases")
+    parser.add_argument(
+        "--communications", type=int, default=8, help="Number of communications per case"
+    )
+    parser.add_argument(
+        "--health-events", dest="health_events", type=int, default=5000, help="Number of Health events"
+    )
+    parser.add_argument(
+        "--ta-checks", dest="ta_checks", type=int, default=450, help="Number of Trusted Advisor checks"
+    )
+    parser.add_argument(
+        "--flagged-resources",
+        dest="flagged_resources",
+        type=int,
+        default=20,
+        help="Number of flagged resources per Trusted Advisor check",
+    )
+    parser.add_argument(
+        "--page-size", dest="page_size", type=int, default=100, help="Items per API page"
+    )
+    parser.add_argument(
+        "--latency-ms", dest="latency_ms", type=float, default=20, help="Simulated latency of each API call"
+    )
+    parser.add_argument("--days", type=int, default=365, help="past_no_of_days of the run")
+    parser.add_argument(
+        "--upload-concurrency", dest="upload_concurrency", type=int, default=10, help="Parallel uploads"
+    )
+    parser.add_argument(
+        "--output-format",
+        dest="output_format",
+        choices=("documents", "partitions", "both"),
+        default="documents",
+        help="Output format of the collectors",
+    )
+    parser.add_argument(
+        "--api-rates",
+        dest="api_rates",
+        type=json.loads,
+        default=None,
+        help='Rate limits as JSON, e.g. \'{"support": 5}\' (default: unlimited)',
+    )
+    parser.add_argument(
+        "--storage-dir",
+        dest="storage_dir",
+        help="Write the documents to this directory instead of the synthetic S3",
+    )
+    parser.add_argument("--output", help="JSON file to write the results to, to compare runs")
+    parser.add_argument(
+        "--trace-memory",
+        dest="trace_memory",
+        action="store_true",
+        help="Also report the peak Python heap with tracemalloc, which slows the collectors down",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the collectors")
+    main(parser.parse_args())
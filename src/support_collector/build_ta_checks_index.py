@@ -0,0 +1,121 @@
+import importlib
+import json
+import os
+import sys
+import argparse
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "support-collector-lambda")
+TA_CHECKS_INFO_FILE = os.path.join(LAMBDA_DIR, "ta_checks_info.json")
+TA_CHECKS_INDEX_FILE = os.path.join(LAMBDA_DIR, "ta_checks_index.json")
+
+# Check ID missing from the checks info file, to compare the fallback descriptions
+UNKNOWN_CHECK_ID = "unknown-check-id"
+
+
+def build_index(checks_info_file):
+    """
+    Build the compact Trusted Advisor lookup used by the Lambda function: only
+    the description of each check, keyed by checkId.
+    """
+    with open(checks_info_file, "r", encoding="utf-8") as f:
+        checks_info = json.load(f)
+
+    return {check["checkId"]: check["description"] for check in checks_info}
+
+
+def serialize_index(index):
+    return json.dumps(index, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def check_index(checks_info_file, index_file):
+    """Verify the index gives the same description as the full JSON for every check."""
+    expected = build_index(checks_info_file)
+    with open(index_file, "r", encoding="utf-8") as f:
+        index = json.load(f)
+
+    mismatches = [
+        check_id
+        for check_id in expected.keys() | index.keys()
+        if expected.get(check_id) != index.get(check_id)
+    ]
+    for check_id in sorted(mismatches):
+        print(f"Description mismatch for check {check_id}")
+    return not mismatches
+
+
+def legacy_lookup(checks_info):
+    """Build the lookup of the full checks info that upload_ta used before the index."""
+    return {
+        check["checkId"]: {"name": check["name"], "description": check["description"]}
+        for check in checks_info
+    }
+
+
+def check_lookup(checks_info_file):
+    """
+    Verify upload_ta.get_check_description, reading the index shipped with the
+    Lambda function, gives the same description as the lookup of the full
+    JSON it replaced, for every check and for an unknown one.
+    """
+    with open(checks_info_file, "r", encoding="utf-8") as f:
+        checks_info = json.load(f)
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    sys.path.insert(0, LAMBDA_DIR)
+    upload_ta = importlib.import_module("upload_ta")
+
+    checks_info_dict = legacy_lookup(checks_info)
+    mismatches = [
+        check_id
+        for check_id in list(checks_info_dict) + [UNKNOWN_CHECK_ID]
+        if upload_ta.get_check_description(check_id)
+        != checks_info_dict.get(check_id, {}).get("description", "No description provided")
+    ]
+    for check_id in mismatches:
+        print(f"Lookup mismatch for check {check_id}")
+    return not mismatches
+
+
+def main(checks_info_file, index_file, check):
+    if check:
+        if not check_index(checks_info_file, index_file):
+            print(f"{index_file} is out of date, please rebuild it.")
+            sys.exit(1)
+        if index_file == TA_CHECKS_INDEX_FILE and not check_lookup(checks_info_file):
+            print("upload_ta.get_check_description doesn't match the previous lookup.")
+            sys.exit(1)
+        print(f"{index_file} is up to date.")
+        return
+
+    index = build_index(checks_info_file)
+    with open(index_file, "w", encoding="utf-8") as f:
+        f.write(serialize_index(index))
+    print(f"Wrote the description of {len(index)} checks to {index_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checks-info-file",
+        dest="checks_info_file",
+        help="Trusted Advisor checks info JSON file",
+        default=TA_CHECKS_INFO_FILE,
+    )
+    parser.add_argument(
+        "--index-file",
+        dest="index_file",
+        help="Compact Trusted Advisor checks index to generate",
+        default=TA_CHECKS_INDEX_FILE,
+    )
+    parser.add_argument(
+        "--check",
+        dest="check",
+        help="Only verify that the index matches the checks info file",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    main(
+        checks_info_file=args.checks_info_file,
+        index_file=args.index_file,
+        check=args.check,
+    )
@@ -1,7 +1,12 @@
 from datetime import datetime
 import json
 import argparse
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 import deploy_stackset
 
@@ -11,31 +16,142 @@ TEMPLATE_FILE = "member_account_resources.yaml"
 TEMPLATE_HISTORICAL_SYNC_FILE = "member_account_historical_data_sync.yaml"
 LAMBDA_ROLE_NAME = "SupportInsightsLambdaRole-9c8794ee-f9e8"
 OUTPUT_DATA_COLLECTOR_BUCKET_POLICY = "output_bucket_policy.json"
+ORG_TREE_CACHE_FILE = "organization_tree_cache.json"
+DEFAULT_ORG_TREE_CACHE_TTL = 3600
+ORG_WALK_CONCURRENCY = 4
 
-org_client = boto3.client("organizations")
+# The Organizations API has a low request rate, its calls are retried with
+# an adaptive client-side rate
+org_client = boto3.client(
+    "organizations", config=Config(retries={"mode": "adaptive", "max_attempts": 10})
+)
 
 
-def get_ou_ids():
-    response = org_client.list_roots()
-    root_id = response["Roots"][0]["Id"]
-    paginator = org_client.get_paginator("list_organizational_units_for_parent")
+def paginate_all(operation_name, result_key, **kwargs):
+    paginator = org_client.get_paginator(operation_name)
+    return [
+        item for page in paginator.paginate(**kwargs) for item in page[result_key]
+    ]
+
+
+def list_accounts_for_parent(parent_id):
+    return paginate_all("list_accounts_for_parent", "Accounts", ParentId=parent_id)
 
-    ou_ids = []
-    for page in paginator.paginate(ParentId=root_id):
-        for ou in page["OrganizationalUnits"]:
-            ou_ids.append(ou["Id"])
 
-    return ou_ids
+def list_children(parent_id):
+    """List the child OUs and the accounts directly under a root or an OU."""
+    child_ous = paginate_all(
+        "list_organizational_units_for_parent",
+        "OrganizationalUnits",
+        ParentId=parent_id,
+    )
+    return child_ous, list_accounts_for_parent(parent_id)
+
+
+def walk_organization(organization_id, concurrency=ORG_WALK_CONCURRENCY):
+    """
+    Walk the whole OU tree of the organization, level by level, listing the
+    children of all the OUs of a level concurrently.
+
+    :param organization_id: The ID of the organization, stored in the tree to
+        validate its cache.
+    :param concurrency: The maximum number of OUs listed in parallel.
+    :return: The tree: the root ID, the parent of each OU and the IDs of the
+        accounts directly under each parent, keyed by OU or root ID.
+    """
+    started = time.monotonic()
+    root_id = org_client.list_roots()["Roots"][0]["Id"]
+    tree = {
+        "organization_id": organization_id,
+        "root_id": root_id,
+        "built_at": time.time(),
+        "ous": {},
+        "accounts": {},
+    }
 
+    level = [root_id]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while level:
+            next_level = []
+            for parent_id, (child_ous, accounts) in zip(
+                level, executor.map(list_children, level)
+            ):
+                tree["accounts"][parent_id] = [account["Id"] for account in accounts]
+                for ou in child_ous:
+                    tree["ous"][ou["Id"]] = {"name": ou["Name"], "parent_id": parent_id}
+                    next_level.append(ou["Id"])
+            level = next_level
+
+    account_count = sum(len(accounts) for accounts in tree["accounts"].values())
+    print(
+        f"Listed {len(tree['ous'])} OUs and {account_count} accounts of the "
+        f"organization in {time.monotonic() - started:.1f}s"
+    )
+    return tree
 
-def get_all_ou_ids(ou_ids):
-    all_ou_ids = get_ou_ids()
 
+def load_cached_organization_tree(organization_id, cache_ttl):
+    """Load the tree cached by a previous run, or None if it expired or is missing."""
+    try:
+        with open(ORG_TREE_CACHE_FILE, "r", encoding="utf-8") as cache_file:
+            tree = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+    age = time.time() - tree.get("built_at", 0)
+    if tree.get("organization_id") != organization_id or not 0 <= age < cache_ttl:
+        return None
+    print(f"Using the organization tree cached in {ORG_TREE_CACHE_FILE} {age:.0f}s ago")
+    return tree
+
+
+def get_organization_tree(cache_ttl=DEFAULT_ORG_TREE_CACHE_TTL):
+    """
+    Get the OU tree of the organization, from the disk cache when it is
+    younger than cache_ttl seconds, otherwise by walking the organization.
+
+    :param cache_ttl: The maximum age of the cached tree in seconds, 0 to
+        always walk the organization.
+    """
+    organization_id = org_client.describe_organization()["Organization"]["Id"]
+    tree = load_cached_organization_tree(organization_id, cache_ttl)
+    if tree is None:
+        tree = walk_organization(organization_id)
+        with open(ORG_TREE_CACHE_FILE, "w", encoding="utf-8") as cache_file:
+            json.dump(tree, cache_file)
+    return tree
+
+
+def ou_path(tree, ou_id):
+    """Get the path of an OU from the root, e.g. r-xxxx/ou-parent/ou-xxxx."""
+    path = [ou_id]
+    while path[-1] in tree["ous"]:
+        path.append(tree["ous"][path[-1]]["parent_id"])
+    return "/".join(reversed(path))
+
+
+def accounts_under(tree, ou_id):
+    """Get the IDs of the accounts of an OU and of all its nested OUs."""
+    child_ous = defaultdict(list)
+    for child_id, ou in tree["ous"].items():
+        child_ous[ou["parent_id"]].append(child_id)
+
+    account_ids = []
+    parents = [ou_id]
+    while parents:
+        parent_id = parents.pop()
+        account_ids.extend(tree["accounts"].get(parent_id, []))
+        parents.extend(child_ous[parent_id])
+    return account_ids
+
+
+def get_all_ou_ids(ou_ids, tree):
     user_input_ou_ids = ou_ids.split(",")
 
     valid_ou_ids = []
     for ou_id in user_input_ou_ids:
-        if ou_id.strip() in all_ou_ids:
+        # Any OU of the tree is valid, nested ones included
+        if ou_id.strip() in tree["ous"]:
             valid_ou_ids.append(ou_id.strip())
         else:
             print(f"OU ID {ou_id.strip()} is not valid.")
@@ -43,30 +159,29 @@ def get_all_ou_ids(ou_ids):
     return valid_ou_ids
 
 
-def list_accounts_for_parent(parent_id):
-    accounts = []
-    paginator = org_client.get_paginator("list_accounts_for_parent")
-    page_iterator = paginator.paginate(ParentId=parent_id)
-
-    for page in page_iterator:
-        accounts.extend(page["Accounts"])
-
-    return accounts
-
-
-def generate_bucket_policy(management_account_bucket_name, valid_ou_ids):
-    accounts_in_ous = []
-    for ou_id in valid_ou_ids:
-        accounts = list_accounts_for_parent(parent_id=ou_id)
-        accounts_in_ous.extend(accounts)
+def generate_bucket_policy(management_account_bucket_name, valid_ou_ids, tree):
+    # The stack sets deploy to the accounts of the nested OUs too
+    account_ids = sorted(
+        {
+            account_id
+            for ou_id in valid_ou_ids
+            for account_id in accounts_under(tree, ou_id)
+        }
+    )
 
     principal_arns = []
-    for account in accounts_in_ous:
-        account_id = account["Id"]
+    for account_id in account_ids:
         principal_arns.append(f"arn:aws:iam::{account_id}:role/{LAMBDA_ROLE_NAME}")
 
-    org_id = org_client.describe_organization()["Organization"]["Id"]
-    org_root_id = org_client.list_roots()["Roots"][0]["Id"]
+    org_id = tree["organization_id"]
+
+    condition = {
+        "ForAnyValue:StringLike": {
+            "aws:PrincipalOrgPaths": [
+                f"{org_id}/{ou_path(tree, ou_id)}/*" for ou_id in valid_ou_ids
+            ]
+        }
+    }
 
     policy = {
         "Version": "2012-10-17",
@@ -76,15 +191,17 @@ def generate_bucket_policy(management_account_bucket_name, valid_ou_ids):
                 "Principal": {"AWS": principal_arns},
                 "Action": ["s3:GetObject", "s3:PutObject", "s3:PutObjectAcl"],
                 "Resource": f"arn:aws:s3:::{management_account_bucket_name}/*",
-                "Condition": {
-                    "ForAnyValue:StringLike": {
-                        "aws:PrincipalOrgPaths": [
-                            f"{org_id}/{org_root_id}/{ou_id}/*"
-                            for ou_id in valid_ou_ids
-                        ]
-                    }
-                },
-            }
+                "Condition": condition,
+            },
+            {
+                # Lets S3 answer NoSuchKey rather than AccessDenied for the
+                # state objects the collectors haven't written yet
+                "Effect": "Allow",
+                "Principal": {"AWS": principal_arns},
+                "Action": "s3:ListBucket",
+                "Resource": f"arn:aws:s3:::{management_account_bucket_name}",
+                "Condition": condition,
+            },
         ],
     }
 
@@ -115,7 +232,7 @@ def update_bucket_policy(bucket_name, policy):
 
 
 def deploy_support_collector_resources(
-    data_bucket_name, region, valid_ou_ids, stackset_name
+    data_bucket_name, region, valid_ou_ids, stackset_name, *, preferences=None
 ):
 
     stack_params = [
@@ -129,47 +246,73 @@ def deploy_support_collector_resources(
         deploy_stackset.deploy_stackset_member_accounts(
             stackset_name,
             TEMPLATE_FILE,
-            region,
+            [region],
             stack_params,
             valid_ou_ids,
+            preferences=preferences,
         )
     )
     return stackset_name_result, operation_id
 
 
-def deploy_support_collector_historic_sync_rule(
-    data_bucket_name, region, valid_ou_ids, stackset_name
-):
+def create_historic_sync_stackset(data_bucket_name, stackset_name):
+    """Create the stack set of the one time historical sync, without instances yet."""
     stack_params = [
         {
             "ParameterKey": "SupportDataManagementBucketName",
             "ParameterValue": data_bucket_name,
         }
     ]
+    try:
+        deploy_stackset.create_stackset(
+            stackset_name, TEMPLATE_HISTORICAL_SYNC_FILE, stack_params
+        )
+    except ClientError as e:
+        print(f"Error in creating StackSet: {e}")
+        return False
+    return True
+
 
+def deploy_support_collector_historic_sync_rule(
+    region, valid_ou_ids, stackset_name, *, preferences=None
+):
     # after all stack are created, the policy on the bucket is set so we can deploy a stackset to run one time historical sync
-    stackset_name_result, operation_id = (
-        deploy_stackset.deploy_stackset_member_accounts(
-            stackset_name,
-            TEMPLATE_HISTORICAL_SYNC_FILE,
-            region,
-            stack_params,
-            valid_ou_ids,
+    try:
+        operation_id = deploy_stackset.create_stack_instances(
+            stackset_name, [region], valid_ou_ids, preferences
         )
+    except ClientError as e:
+        print(f"Error in deploying StackSet: {e}")
+        operation_id = None
+    return stackset_name, operation_id
+
+
+def wait_for_stackset(stackset_name, operation_id):
+    print(
+        f"Now waiting for the CloudFormation StackSets {stackset_name} to complete... Please do not exit this shell."
     )
-    return stackset_name_result, operation_id
+    return deploy_stackset.wait_for_stackset_creation(stackset_name, operation_id)
 
 
-def main(data_bucket_name, ou_ids, overwrite_data_bucket_policy):
+def main(
+    data_bucket_name,
+    ou_ids,
+    overwrite_data_bucket_policy,
+    org_cache_ttl=DEFAULT_ORG_TREE_CACHE_TTL,
+    preferences=None,
+):
     if not s3_bucket_exists(bucket_name=data_bucket_name):
         print(f"Bucket {data_bucket_name} does not exist. Exiting...")
         return
 
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     stackset_name = f"{STACKSET_PREFIX}-{timestamp}"
+    historical_stackset_name = f"{STACKSET_HISTORICAL_PREFIX}-{timestamp}"
 
     region = boto3.Session().region_name
-    valid_ou_ids = get_all_ou_ids(ou_ids)
+    # The tree is built once and feeds both the validation and the policy
+    tree = get_organization_tree(org_cache_ttl)
+    valid_ou_ids = get_all_ou_ids(ou_ids, tree)
     if not valid_ou_ids:
         print("No valid OU IDs provided. Exiting...")
         return
@@ -180,46 +323,41 @@ def main(data_bucket_name, ou_ids, overwrite_data_bucket_policy):
         region=region,
         valid_ou_ids=valid_ou_ids,
         stackset_name=stackset_name,
+        preferences=preferences,
     )
 
-    print(
-        f"Now waiting for the CloudFormation StackSets {stackset_name_result} to complete... Please do not exit this shell."
-    )
-    deployment_succeeded = deploy_stackset.wait_for_stackset_creation(
-        stackset_name_result, operation_id
+    # While the member accounts are being deployed, prepare the bucket policy
+    # and the historical sync stack set, which only need their stacks to exist
+    # once the historical sync instances are deployed
+    print("Generating policy for the data bucket...")
+    policy = generate_bucket_policy(data_bucket_name, valid_ou_ids, tree)
+    historical_stackset_created = create_historic_sync_stackset(
+        data_bucket_name, historical_stackset_name
     )
 
-    if deployment_succeeded:
-        print("Generating policy for the data bucket...")
-        policy = generate_bucket_policy(data_bucket_name, valid_ou_ids)
+    if not wait_for_stackset(stackset_name_result, operation_id):
+        return
 
-        if overwrite_data_bucket_policy:
-            print("StackSet completed. Updating data bucket policy...")
-            update_bucket_policy(data_bucket_name, policy)
-            print("Data bucket policy updated.")
-        else:
-            print("Not updating the data bucket policy...")
+    if overwrite_data_bucket_policy:
+        print("StackSet completed. Updating data bucket policy...")
+        update_bucket_policy(data_bucket_name, policy)
+        print("Data bucket policy updated.")
+    else:
+        print("Not updating the data bucket policy...")
 
-        print(
-            "Deploying a stack set with a one time rule to trigger a sync of the historical support data..."
-        )
-        stackset_name = f"{STACKSET_HISTORICAL_PREFIX}-{timestamp}"
-        stackset_name_result, operation_id = (
-            deploy_support_collector_historic_sync_rule(
-                data_bucket_name=data_bucket_name,
-                region=region,
-                valid_ou_ids=valid_ou_ids,
-                stackset_name=stackset_name,
-            )
-        )
-
-        print(
-            f"Now waiting for the CloudFormation StackSets {stackset_name_result} to complete... Please do not exit this shell."
-        )
-        if deploy_stackset.wait_for_stackset_creation(
-            stackset_name_result, operation_id
-        ):
-            print("StackSet completed! All done.")
+    if not historical_stackset_created:
+        return
+    print(
+        "Deploying a stack set with a one time rule to trigger a sync of the historical support data..."
+    )
+    stackset_name_result, operation_id = deploy_support_collector_historic_sync_rule(
+        region=region,
+        valid_ou_ids=valid_ou_ids,
+        stackset_name=historical_stackset_name,
+        preferences=preferences,
+    )
+    if wait_for_stackset(stackset_name_result, operation_id):
+        print("StackSet completed! All done.")
 
 
 if __name__ == "__main__":
@@ -242,10 +380,20 @@ if __name__ == "__main__":
         action=argparse.BooleanOptionalAction,
         required=False,
     )
+    parser.add_argument(
+        "--org-cache-ttl",
+        dest="org_cache_ttl",
+        help=f"Maximum age in seconds of the cached organization tree in {ORG_TREE_CACHE_FILE}, 0 to list the organization again (default: {DEFAULT_ORG_TREE_CACHE_TTL})",
+        default=DEFAULT_ORG_TREE_CACHE_TTL,
+        type=int,
+    )
+    deploy_stackset.add_operation_preferences_arguments(parser)
     args = parser.parse_args()
 
     main(
         data_bucket_name=args.data_bucket,
         ou_ids=args.ou_ids,
         overwrite_data_bucket_policy=args.overwrite_data_bucket_policy,
+        org_cache_ttl=args.org_cache_ttl,
+        preferences=deploy_stackset.preferences_from_arguments(args),
     )
@@ -1,135 +1,287 @@
-import time
-import boto3
-from botocore.exceptions import ClientError
-
-
-def deploy_stackset_member_accounts(
-    stackset_name,
-    template_file,
-    region,
-    stack_params,
-    valid_ou_ids,
-):
-    cf_client = boto3.client("cloudformation")
-    with open(template_file, "r", encoding="utf-8") as file:
-        template_body = file.read()
-
-    try:
-        # Create StackSet with Parameters
-        response_stackset_id = cf_client.create_stack_set(
-            StackSetName=stackset_name,
-            TemplateBody=template_body,
-            Parameters=stack_params,
-            Capabilities=["CAPABILITY_NAMED_IAM", "CAPABILITY_AUTO_EXPAND"],
-            PermissionModel="SERVICE_MANAGED",
-            AutoDeployment={"Enabled": True, "RetainStacksOnAccountRemoval": False},
-        )
-        print(f"StackSet {stackset_name} created.")
-
-        # Create Stack Instances
-        deployment_targets = {"OrganizationalUnitIds": valid_ou_ids}
-
-        response_operation_id = cf_client.create_stack_instances(
-            StackSetName=stackset_name,
-            DeploymentTargets=deployment_targets,
-            Regions=[region],
-        )
-        operation_id = response_operation_id["OperationId"]
-        print(f"Stack instances for {stackset_name} are being deployed in {region}.")
-    except Exception as e:
-        print(f"Error in deploying StackSet: {e}")
-    return stackset_name, operation_id
-
-
-def wait_for_stackset_creation(stackset_name, operation_id):
-    cf_client = boto3.client("cloudformation")
-
-    # there is no waiter for stackset at this time: https://github.com/aws/aws-sdk/issues/300
-    # waiter = cf_client.get_waiter('stack_create_complete')
-
-    # try:
-    #     waiter.wait(
-    #         StackName=stackset_name,
-    #         WaiterConfig={
-    #             'Delay': 15,
-    #             'MaxAttempts': 360
-    #         }
-    #     )
-    #     print('StackSet creation completed successfully.')
-    # except WaiterError as e:
-    #     print(f'StackSet creation failed: {e}')
-
-    # cf_client.describe_stack_set(StackSetName=stackset_name)
-    while True:
-        try:
-            operation_response = cf_client.describe_stack_set_operation(
-                StackSetName=stackset_name, OperationId=operation_id
-            )
-            status = operation_response["StackSetOperation"]["Status"]
-            if status == "SUCCEEDED":
-                print("StackSet operation completed successfully.")
-                return True
-            if status == "FAILED":
-                print("StackSet operation failed, please check console for details.")
-                return False
-            print(f"StackSet operation status: {status}")
-            time.sleep(15)
-        except ClientError as e:
-            print(f'Error: {e.response["Error"]["Message"]}')
-            return False
-
-    return True
-
-
-if __name__ == "__main__":
-    import argparse
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--stackset-name", required=True, help="Name of the StackSet")
-    parser.add_argument(
-        "--template-file",
-        required=True,
-        help="Path to the CloudFormation template file",
-    )
-    parser.add_argument(
-        "--region", required=True, help="AWS region for the StackSet deployment"
-    )
-    parser.add_argument(
-        "--support-data-management-bucket-name",
-        required=True,
-        help="Name of the S3 bucket in the management account for data collection",
-    )
-    parser.add_argument(
-        "--resource-management-bucket-name",
-        required=True,
-        help="Name of the S3 bucket in the management account for Lambda package",
-    )
-    parser.add_argument(
-        "--role-name",
-        required=True,
-        help="Name of the IAM role for the Lambda function",
-    )
-    parser.add_argument(
-        "--valid-ou-ids", required=True, nargs="+", help="List of valid OU IDs"
-    )
-
-    args = parser.parse_args()
-
-    params = [
-        {"ParameterKey": "LambdaRoleName", "ParameterValue": args.role_name},
-        {
-            "ParameterKey": "SupportDataManagementBucketName",
-            "ParameterValue": args.support_data_management_bucket_name,
-        },
-        {
-            "ParameterKey": "ResourceManagementBucketName",
-            "ParameterValue": args.resource_management_bucket_name,
-        },
-    ]
-    deploy_stackset_member_accounts(
-        stackset_name=args.stackset_name,
-        template_file=args.template_file,
-        region=args.region,
-        stack_params=params,
-        valid_ou_ids=args.valid_ou_ids
-    )
+import argparse
+import time
+from collections import Counter
+import boto3
+from botocore.exceptions import ClientError
+
+# Stack set operations roll out to all the accounts of the OUs at once and
+# keep going after failures, up to the failure tolerance
+DEFAULT_REGION_CONCURRENCY = "PARALLEL"
+DEFAULT_MAX_CONCURRENT_PERCENTAGE = 100
+DEFAULT_FAILURE_TOLERANCE_PERCENTAGE = 0
+
+# Polling of the stack set operations: the delay grows while the operation
+# makes no progress and is reset when instances complete
+MIN_POLL_DELAY = 5
+MAX_POLL_DELAY = 60
+POLL_BACKOFF_FACTOR = 1.5
+
+
+def operation_preferences(
+    region_concurrency=DEFAULT_REGION_CONCURRENCY,
+    max_concurrent_percentage=DEFAULT_MAX_CONCURRENT_PERCENTAGE,
+    failure_tolerance_percentage=DEFAULT_FAILURE_TOLERANCE_PERCENTAGE,
+):
+    """
+    Build the OperationPreferences of the stack set operations.
+
+    :param region_concurrency: "PARALLEL" to deploy to all the regions at
+        once, or "SEQUENTIAL" to deploy one region after the other.
+    :param max_concurrent_percentage: The percentage of the accounts of each
+        region deployed at the same time.
+    :param failure_tolerance_percentage: The percentage of the accounts of
+        each region that can fail before the operation stops.
+    """
+    return {
+        "RegionConcurrencyType": region_concurrency,
+        "MaxConcurrentPercentage": max_concurrent_percentage,
+        "FailureTolerancePercentage": failure_tolerance_percentage,
+        # Without it, the concurrency is capped to the failure tolerance plus one
+        "ConcurrencyMode": "SOFT_FAILURE_TOLERANCE",
+    }
+
+
+def create_stackset(stackset_name, template_file, stack_params):
+    cf_client = boto3.client("cloudformation")
+    with open(template_file, "r", encoding="utf-8") as file:
+        template_body = file.read()
+
+    # Create StackSet with Parameters
+    cf_client.create_stack_set(
+        StackSetName=stackset_name,
+        TemplateBody=template_body,
+        Parameters=stack_params,
+        Capabilities=["CAPABILITY_NAMED_IAM", "CAPABILITY_AUTO_EXPAND"],
+        PermissionModel="SERVICE_MANAGED",
+        AutoDeployment={"Enabled": True, "RetainStacksOnAccountRemoval": False},
+    )
+    print(f"StackSet {stackset_name} created.")
+
+
+def create_stack_instances(stackset_name, regions, valid_ou_ids, preferences=None):
+    """
+    Deploy the stack instances of a stack set to all the accounts of the OUs,
+    in all the regions, in a single operation.
+
+    :return: The ID of the stack set operation.
+    """
+    cf_client = boto3.client("cloudformation")
+
+    # Create Stack Instances
+    deployment_targets = {"OrganizationalUnitIds": valid_ou_ids}
+
+    response_operation_id = cf_client.create_stack_instances(
+        StackSetName=stackset_name,
+        DeploymentTargets=deployment_targets,
+        Regions=regions,
+        OperationPreferences=preferences or operation_preferences(),
+    )
+    print(
+        f"Stack instances for {stackset_name} are being deployed in {', '.join(regions)}."
+    )
+    return response_operation_id["OperationId"]
+
+
+def deploy_stackset_member_accounts(
+    stackset_name,
+    template_file,
+    regions,
+    stack_params,
+    valid_ou_ids,
+    *,
+    preferences=None,
+):
+    """
+    Create a stack set and deploy it to the accounts of the OUs.
+
+    :param regions: The regions to deploy the stack instances to.
+    :param preferences: The OperationPreferences returned by
+        operation_preferences, or None for the defaults.
+    :return: The stack set name, and the ID of the operation deploying its
+        instances, or None if the deployment couldn't start.
+    """
+    operation_id = None
+    try:
+        create_stackset(stackset_name, template_file, stack_params)
+        operation_id = create_stack_instances(
+            stackset_name, regions, valid_ou_ids, preferences
+        )
+    except Exception as e:
+        print(f"Error in deploying StackSet: {e}")
+    return stackset_name, operation_id
+
+
+def operation_progress(cf_client, stackset_name, operation_id):
+    """
+    Get the results of the stack instances of an operation so far.
+
+    :return: The number of instances in each status, and the failed results.
+    """
+    paginator = cf_client.get_paginator("list_stack_set_operation_results")
+    counts = Counter()
+    failures = []
+    for page in paginator.paginate(StackSetName=stackset_name, OperationId=operation_id):
+        for result in page["Summaries"]:
+            counts[result["Status"]] += 1
+            if result["Status"] == "FAILED":
+                failures.append(result)
+    return counts, failures
+
+
+def format_progress(counts):
+    return ", ".join(f"{count} {status.lower()}" for status, count in sorted(counts.items()))
+
+
+def wait_for_stackset_creation(stackset_name, operation_id):
+    """
+    Wait for a stack set operation to end, reporting the progress of its
+    stack instances.
+
+    :return: Whether the operation succeeded.
+    """
+    if operation_id is None:
+        return False
+    cf_client = boto3.client("cloudformation")
+
+    # there is no waiter for stackset at this time: https://github.com/aws/aws-sdk/issues/300
+    delay = MIN_POLL_DELAY
+    last_counts = None
+    while True:
+        try:
+            operation_response = cf_client.describe_stack_set_operation(
+                StackSetName=stackset_name, OperationId=operation_id
+            )
+            status = operation_response["StackSetOperation"]["Status"]
+            counts, failures = operation_progress(cf_client, stackset_name, operation_id)
+        except ClientError as e:
+            print(f'Error: {e.response["Error"]["Message"]}')
+            return False
+
+        for failure in failures:
+            print(
+                f"Stack instance failed in account {failure['Account']} "
+                f"({failure['Region']}): {failure.get('StatusReason', 'no reason given')}"
+            )
+        if status == "SUCCEEDED":
+            print(f"StackSet operation completed successfully: {format_progress(counts)}.")
+            return True
+        if status in ("FAILED", "STOPPED"):
+            print(
+                f"StackSet operation {status.lower()}: {format_progress(counts)}. "
+                "Please check console for details."
+            )
+            return False
+
+        print(f"StackSet operation status: {status}, stack instances: {format_progress(counts)}")
+        if counts != last_counts:
+            delay = MIN_POLL_DELAY
+        else:
+            delay = min(MAX_POLL_DELAY, delay * POLL_BACKOFF_FACTOR)
+        last_counts = counts
+        time.sleep(delay)
+
+
+def percentage(value, minimum=0):
+    number = int(value)
+    if not minimum <= number <= 100:
+        raise argparse.ArgumentTypeError(f"{value} is not between {minimum} and 100")
+    return number
+
+
+def concurrent_percentage(value):
+    # At least one account is deployed at a time
+    return percentage(value, minimum=1)
+
+
+def add_operation_preferences_arguments(argument_parser):
+    """Add the command line options of the stack set operation preferences."""
+    argument_parser.add_argument(
+        "--region-concurrency",
+        dest="region_concurrency",
+        choices=["PARALLEL", "SEQUENTIAL"],
+        default=DEFAULT_REGION_CONCURRENCY,
+        help=f"Deploy the regions in parallel or one after the other (default: {DEFAULT_REGION_CONCURRENCY})",
+    )
+    argument_parser.add_argument(
+        "--max-concurrent-percentage",
+        dest="max_concurrent_percentage",
+        type=concurrent_percentage,
+        default=DEFAULT_MAX_CONCURRENT_PERCENTAGE,
+        help=f"Percentage of the accounts deployed at the same time in each region (default: {DEFAULT_MAX_CONCURRENT_PERCENTAGE})",
+    )
+    argument_parser.add_argument(
+        "--failure-tolerance-percentage",
+        dest="failure_tolerance_percentage",
+        type=percentage,
+        default=DEFAULT_FAILURE_TOLERANCE_PERCENTAGE,
+        help=f"Percentage of the accounts that can fail in each region before the deployment stops (default: {DEFAULT_FAILURE_TOLERANCE_PERCENTAGE})",
+    )
+
+
+def preferences_from_arguments(arguments):
+    """Build the OperationPreferences from the parsed command line options."""
+    return operation_preferences(
+        arguments.region_concurrency,
+        arguments.max_concurrent_percentage,
+        arguments.failure_tolerance_percentage,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stackset-name", required=True, help="Name of the StackSet")
+    parser.add_argument(
+        "--template-file",
+        required=True,
+        help="Path to the CloudFormation template file",
+    )
+    parser.add_argument(
+        # --region is kept for the existing commands
+        "--regions",
+        "--region",
+        dest="regions",
+        required=True,
+        nargs="+",
+        help="AWS regions for the StackSet deployment",
+    )
+    parser.add_argument(
+        "--support-data-management-bucket-name",
+        required=True,
+        help="Name of the S3 bucket in the management account for data collection",
+    )
+    parser.add_argument(
+        "--resource-management-bucket-name",
+        required=True,
+        help="Name of the S3 bucket in the management account for Lambda package",
+    )
+    parser.add_argument(
+        "--role-name",
+        required=True,
+        help="Name of the IAM role for the Lambda function",
+    )
+    parser.add_argument(
+        "--valid-ou-ids", required=True, nargs="+", help="List of valid OU IDs"
+    )
+    add_operation_preferences_arguments(parser)
+
+    args = parser.parse_args()
+
+    params = [
+        {"ParameterKey": "LambdaRoleName", "ParameterValue": args.role_name},
+        {
+            "ParameterKey": "SupportDataManagementBucketName",
+            "ParameterValue": args.support_data_management_bucket_name,
+        },
+        {
+            "ParameterKey": "ResourceManagementBucketName",
+            "ParameterValue": args.resource_management_bucket_name,
+        },
+    ]
+    deploy_stackset_member_accounts(
+        stackset_name=args.stackset_name,
+        template_file=args.template_file,
+        regions=args.regions,
+        stack_params=params,
+        valid_ou_ids=args.valid_ou_ids,
+        preferences=preferences_from_arguments(args),
+    )
@@ -7,10 +7,13 @@ echo "Installing dependencies into a temporary directory..."
 mkdir temp_dir
 pip3 install -r requirements.txt -t temp_dir/
 
+echo "Building the Trusted Advisor checks index..."
+python3 build_ta_checks_index.py
+
 echo "Copying dependencies to the Lambda directory..."
 cp -r temp_dir/* support-collector-lambda/
 
 echo "Creating deployment package..."
 cd support-collector-lambda
-zip -r ../support-collector-lambda.zip . -x '*.DS_Store' 2>/dev/null || true
+zip -r ../support-collector-lambda.zip . -x '*.DS_Store' 'ta_checks_info.json' 2>/dev/null || true
 cd ..
@@ -0,0 +1,140 @@
+import json
+import time
+from datetime import datetime
+
+from checkpoint import commit_checkpoint
+from clients import AwsClients
+from metrics import LIST, NO_METRICS, retry_attempts
+
+# Time kept to finish the uploads in flight and hand over the rest of the
+# backfill before the Lambda function times out
+DEFAULT_RESERVED_TIME_MS = 120 * 1000
+
+
+class TimeBudget:
+    """Remaining execution time of the Lambda invocation"""
+
+    def __init__(self, context, reserved_time_ms=DEFAULT_RESERVED_TIME_MS):
+        self.context = context
+        self.reserved_time_ms = reserved_time_ms
+
+    def expired(self):
+        return self.context.get_remaining_time_in_millis() < self.reserved_time_ms
+
+
+class Continuation:
+    """
+    Pagination progress of a collector, so that a backfill interrupted by the
+    time budget resumes in another invocation from the last uploaded page.
+
+    :param time_budget: The TimeBudget of the invocation, or None to never stop.
+    :param state: The state saved by the interrupted invocation, if any.
+    :param metrics: The CollectorMetrics recording the list phase.
+    """
+
+    def __init__(self, time_budget=None, state=None, metrics=NO_METRICS):
+        state = state or {}
+        self.time_budget = time_budget
+        self.metrics = metrics
+        # Collector specific query window, pagination tokens are only valid for it
+        self.window = state.get("window")
+        self.next_token = state.get("next_token")
+        # Checkpoint committed once the last page of the backfill is uploaded
+        self.high_water_mark = None
+        if state.get("high_water_mark"):
+            self.high_water_mark = datetime.fromisoformat(state["high_water_mark"])
+        self.failed = state.get("failed", 0)
+        self.interrupted = False
+
+    def pages(self, paginator, **kwargs):
+        """
+        Paginate from the saved token. Pages are yielded one at a time and the
+        pagination stops at a page boundary once the time budget has expired.
+        """
+        if self.next_token:
+            kwargs["PaginationConfig"] = {"StartingToken": self.next_token}
+
+        page_iterator = iter(paginator.paginate(**kwargs))
+        while True:
+            started = time.perf_counter()
+            page = next(page_iterator, None)
+            if page is None:
+                return
+            self.metrics.add(
+                LIST,
+                DurationMs=(time.perf_counter() - started) * 1000,
+                ApiCalls=1,
+                # The items of a page are its list, e.g. "cases" or "events"
+                Items=sum(len(value) for value in page.values() if isinstance(value, list)),
+                Retries=retry_attempts(page),
+            )
+            self.next_token = page.get("nextToken")
+            yield page
+            # The consumer asks for more once all the items of the page are queued
+            if self.next_token and self.time_budget and self.time_budget.expired():
+                self.interrupted = True
+                return
+
+    def complete(self, report, bucket_name, account_id, collector):
+        """
+        End the invocation of a collector: if it ran out of time, the state to
+        resume it is added to its upload report, otherwise the checkpoint of
+        the collector is committed.
+        """
+        self.failed += len(report["failed"])
+        if self.interrupted:
+            report["continuation"] = self.to_state()
+        else:
+            commit_checkpoint(
+                bucket_name, account_id, collector, self.high_water_mark, self.failed
+            )
+        return report
+
+    def to_state(self):
+        return {
+            "window": self.window,
+            "next_token": self.next_token,
+            "high_water_mark": self.high_water_mark.isoformat(),
+            "failed": self.failed,
+        }
+
+
+def invoke_continuation(context, event, continuations):
+    """
+    Re-invoke the Lambda function asynchronously to resume the interrupted
+    collectors, the other collectors being disabled.
+
+    :param context: The Lambda context of the current invocation.
+    :param event: The scheduler event of the current invocation.
+    :param continuations: The saved states keyed by collector flag ("case", "health").
+    """
+    next_event = dict(event, case=False, health=False, ta=False)
+    next_event.update({flag: True for flag in continuations})
+    next_event["continuation"] = continuations
+
+    invoke_next(context, next_event)
+    print(f"Backfill continues in a new invocation for: {', '.join(continuations)}")
+
+
+def invoke_accounts_continuation(context, event, continuations):
+    """
+    Re-invoke the Lambda function asynchronously to resume the collection of
+    the member accounts that were interrupted or not started.
+
+    :param context: The Lambda context of the current invocation.
+    :param event: The scheduler event of the current invocation.
+    :param continuations: The saved states keyed by account ID, then by
+        collector flag, a None state starting the collector from scratch.
+    """
+    next_event = dict(event, accounts=list(continuations), continuation=continuations)
+
+    invoke_next(context, next_event)
+    print(f"Collection continues in a new invocation for {len(continuations)} accounts")
+
+
+def invoke_next(context, next_event):
+    AwsClients.client("lambda").invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps(next_event).encode("utf-8"),
+    )
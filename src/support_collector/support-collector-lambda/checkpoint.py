@@ -0,0 +1,67 @@
+import json
+from datetime import datetime, timezone
+import logging
+
+from s3_uploader import read_state
+from storage import storage_sink
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+CHECKPOINT_PREFIX = "sync-state"
+
+
+def checkpoint_key(account_id, collector):
+    return f"{CHECKPOINT_PREFIX}/{account_id}/{collector}.json"
+
+
+def load_checkpoint(bucket_name, account_id, collector):
+    """
+    Load the high-water mark of the last successful run of a collector.
+
+    :param bucket_name: The S3 bucket holding the support data.
+    :param account_id: AWS account ID.
+    :param collector: The collector name, e.g. "cases" or "health".
+    :return: The high-water mark as a timezone-aware datetime, or None when
+        the collector never completed a run for this account.
+    """
+    file_key = checkpoint_key(account_id, collector)
+    body = read_state(bucket_name, file_key)
+    if body is None:
+        return None
+
+    state = json.loads(body.decode("utf-8"))
+    high_water_mark = datetime.fromisoformat(state["high_water_mark"])
+    print(f"Resuming {collector} sync from checkpoint {high_water_mark.isoformat()}")
+    return high_water_mark
+
+
+def save_checkpoint(bucket_name, account_id, collector, high_water_mark):
+    """
+    Persist the high-water mark of a collector. Only call this once all the
+    documents of the run have been uploaded, so a failed run retries its window.
+    """
+    state = {
+        "account_id": account_id,
+        "collector": collector,
+        "high_water_mark": high_water_mark.isoformat(),
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }
+    file_key = checkpoint_key(account_id, collector)
+    storage_sink(bucket_name).put(file_key, json.dumps(state).encode("utf-8"))
+    print(f"Saved {collector} checkpoint {high_water_mark.isoformat()}")
+
+
+def commit_checkpoint(
+    bucket_name, account_id, collector, high_water_mark, failed_count
+):
+    """Advance the checkpoint if every upload of the run succeeded."""
+    if failed_count:
+        logger.warning(
+            "Not advancing the %s checkpoint, %d uploads failed",
+            collector,
+            failed_count,
+        )
+        return False
+    save_checkpoint(bucket_name, account_id, collector, high_water_mark)
+    return True
@@ -0,0 +1,168 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import boto3
+from botocore.config import Config
+
+from rate_limiter import limit_client
+
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+MAX_RETRY_ATTEMPTS = 5
+
+# Assumed role credentials are refreshed when they expire within this margin
+CREDENTIALS_REFRESH_MARGIN = timedelta(minutes=5)
+ROLE_SESSION_NAME = "SupportInsightsCollector"
+# Services called in the account being collected, the others (S3, Lambda,
+# STS) are always called with the credentials of the Lambda function
+ACCOUNT_SERVICES = ("support", "health")
+
+session = boto3.Session()
+
+# Role assumed in the account collected by the current thread, None to
+# collect the account of the Lambda function
+collected_role = contextvars.ContextVar("collected_role", default=None)
+
+
+def client_config(max_pool_connections):
+    return Config(
+        max_pool_connections=max_pool_connections,
+        tcp_keepalive=True,
+        retries={"mode": "adaptive", "max_attempts": MAX_RETRY_ATTEMPTS},
+    )
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    Thread pool running each task in a copy of the context of the thread that
+    submits it, so the workers of a collector call the APIs in the account it
+    collects.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def role_account(role_arn):
+    # Role ARNs are "arn:<partition>:iam::<account_id>:role/<name>"
+    return role_arn.split(":")[4]
+
+
+class AssumedRoles:
+    """
+    Credentials of the roles assumed in the collected accounts, cached until
+    they are about to expire.
+    """
+
+    __credentials = {}
+    __lock = threading.Lock()
+
+    @staticmethod
+    def credentials(role_arn):
+        """
+        Get the temporary credentials of a role, assuming it again when the
+        cached ones expire within CREDENTIALS_REFRESH_MARGIN.
+
+        :param role_arn: The ARN of the role.
+        :return: The credentials returned by STS, with the role ARN.
+        """
+        with AssumedRoles.__lock:
+            credentials = AssumedRoles.__credentials.get(role_arn)
+        refresh_at = datetime.now(timezone.utc) + CREDENTIALS_REFRESH_MARGIN
+        if credentials and credentials["Expiration"] > refresh_at:
+            return credentials
+
+        # Assumed outside of the lock, so the roles of several accounts are
+        # assumed concurrently
+        response = AwsClients.client("sts").assume_role(
+            RoleArn=role_arn, RoleSessionName=ROLE_SESSION_NAME
+        )
+        credentials = dict(response["Credentials"], RoleArn=role_arn)
+        with AssumedRoles.__lock:
+            AssumedRoles.__credentials[role_arn] = credentials
+        return credentials
+
+
+class AwsClients:
+    """
+    Registry of the boto3 clients keyed by service, region and credentials.
+    The clients are kept at module level, so they are reused by all the
+    collectors and across warm invocations of the Lambda function. The
+    requests of the Support, Health and S3 clients are rate limited.
+
+    The Support and Health clients of a thread collecting another account
+    use the credentials of the role assumed in that account, and are rebuilt
+    when the credentials are refreshed.
+    """
+
+    __clients = {}
+    __pool_sizes = {}
+    __access_keys = {}
+    __lock = threading.Lock()
+
+    @staticmethod
+    def client(
+        service,
+        region_name=None,
+        credentials=None,
+        max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS,
+    ):
+        """
+        Get a shared client, creating it on first use.
+
+        :param service: The AWS service name, e.g. "s3" or "support".
+        :param region_name: The region of the client, defaults to the session region.
+        :param credentials: Temporary credentials returned by STS, or None to
+            use the credentials of the Lambda function, or of the role of the
+            collected account for the Support and Health clients.
+        :param max_pool_connections: The number of threads that will use the
+            client concurrently. The client is rebuilt with a bigger connection
+            pool if needed.
+        :return: The boto3 client.
+        """
+        region_name = region_name or session.region_name
+        if credentials is None and service in ACCOUNT_SERVICES and collected_role.get():
+            credentials = AssumedRoles.credentials(collected_role.get())
+        access_key = credentials["AccessKeyId"] if credentials else None
+        # The clients of a role are keyed by its ARN, so they are replaced
+        # rather than added when its credentials are refreshed
+        key = (
+            service,
+            region_name,
+            credentials.get("RoleArn", access_key) if credentials else None,
+        )
+
+        # Creating clients from a session is not thread-safe
+        with AwsClients.__lock:
+            if (
+                AwsClients.__pool_sizes.get(key, 0) < max_pool_connections
+                or AwsClients.__access_keys.get(key) != access_key
+            ):
+                pool_size = max(
+                    max_pool_connections,
+                    DEFAULT_MAX_POOL_CONNECTIONS,
+                    AwsClients.__pool_sizes.get(key, 0),
+                )
+                credentials_kwargs = {}
+                if credentials:
+                    credentials_kwargs = {
+                        "aws_access_key_id": credentials["AccessKeyId"],
+                        "aws_secret_access_key": credentials["SecretAccessKey"],
+                        "aws_session_token": credentials["SessionToken"],
+                    }
+                AwsClients.__clients[key] = limit_client(
+                    session.client(
+                        service,
+                        region_name=region_name,
+                        config=client_config(pool_size),
+                        **credentials_kwargs,
+                    ),
+                    # The API quotas of the collected accounts are separate
+                    role_account(credentials["RoleArn"])
+                    if credentials and "RoleArn" in credentials
+                    else None,
+                )
+                AwsClients.__pool_sizes[key] = pool_size
+                AwsClients.__access_keys[key] = access_key
+
+            return AwsClients.__clients[key]
@@ -0,0 +1,276 @@
+import json
+import logging
+import threading
+from collections import deque
+from botocore.exceptions import ClientError
+
+from checkpoint import CHECKPOINT_PREFIX
+from clients import AwsClients, ContextThreadPoolExecutor
+from manifest import document_account
+from metrics import DETAILS, NO_METRICS, retry_attempts
+from partitions import PARTITIONS, partition_key, read_partition
+from s3_uploader import read_state
+from serialization import decode_body
+from storage import storage_sink
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+COMMUNICATIONS_FETCH_CONCURRENCY = 5
+
+
+def communication_id(communication):
+    # Communications have no identifier, the same message is never sent twice
+    # at the same time by the same author
+    return (
+        communication["timeCreated"],
+        communication.get("submittedBy"),
+        communication.get("body"),
+    )
+
+
+def threads_key(account_id):
+    return f"{CHECKPOINT_PREFIX}/{account_id}/cases-threads.json"
+
+
+def load_stored_case(bucket_name, file_key):
+    """Load the case document stored by a previous run, or None if there is none."""
+    body = decode_body(read_state(bucket_name, file_key))
+    return json.loads(body.decode("utf-8")) if body is not None else None
+
+
+class CommunicationThreads:
+    """
+    The time up to which the stored thread of each case is complete, kept
+    per account next to the checkpoint of the cases, so the stored documents
+    are only read for the cases whose thread can't be completed from the
+    recent communications embedded by DescribeCases.
+
+    The stored threads are read from the case documents, or from their
+    partition when there is no document, each partition being read once. The
+    times are only recorded for the documents written successfully.
+
+    :param bucket_name: The S3 bucket holding the support data.
+    :param output_format: The output format of the run: with "partitions",
+        the threads are read from the partitions only.
+    """
+
+    def __init__(self, bucket_name, output_format=None):
+        self.bucket_name = bucket_name
+        self.output_format = output_format
+        self.__times = {}
+        self.__pending = {}
+        self.__partitions = {}
+        self.__lock = threading.Lock()
+
+    def account_times(self, account_id):
+        with self.__lock:
+            if account_id in self.__times:
+                return self.__times[account_id]
+        body = read_state(self.bucket_name, threads_key(account_id))
+        times = json.loads(body.decode("utf-8"))["cases"] if body is not None else {}
+        with self.__lock:
+            return self.__times.setdefault(account_id, times)
+
+    def complete_until(self, file_key):
+        return self.account_times(document_account(file_key)).get(file_key)
+
+    def partition(self, key):
+        with self.__lock:
+            if key in self.__partitions:
+                return self.__partitions[key]
+        records = read_partition(self.bucket_name, key)
+        with self.__lock:
+            return self.__partitions.setdefault(key, records)
+
+    def stored_communications(self, file_key):
+        """Get the stored thread of a case, or None if the case isn't stored."""
+        stored = None
+        if self.output_format != PARTITIONS:
+            stored = load_stored_case(self.bucket_name, file_key)
+        if stored is None:
+            record = self.partition(partition_key(file_key)).get(file_key)
+            if record is None:
+                return None
+            stored = json.loads(record)["document"]
+        return stored.get("communications", [])
+
+    def note(self, file_key, complete_until):
+        """Note the time up to which the thread of a case is complete, until its upload report."""
+        with self.__lock:
+            self.__pending[file_key] = complete_until
+
+    def save(self, report):
+        """Record the times of the cases written successfully, or unchanged, and store them."""
+        written = set(report["succeeded"]) | set(report["skipped"])
+        changed_accounts = set()
+        for file_key, complete_until in self.__pending.items():
+            if file_key in written or partition_key(file_key) in written:
+                account_id = document_account(file_key)
+                times = self.account_times(account_id)
+                if times.get(file_key) != complete_until:
+                    times[file_key] = complete_until
+                    changed_accounts.add(account_id)
+        self.__pending.clear()
+        for account_id in sorted(changed_accounts):
+            storage_sink(self.bucket_name).put(
+                threads_key(account_id),
+                json.dumps({"account_id": account_id, "cases": self.__times[account_id]}).encode(
+                    "utf-8"
+                ),
+            )
+
+
+def iter_communications(case_id, after_time=None, metrics=NO_METRICS):
+    """
+    Yield the communications of a case, newest first.
+
+    :param case_id: The support case ID (not the display ID).
+    :param after_time: Only yield the communications created after this time.
+    :param metrics: The CollectorMetrics counting the calls of the details phase.
+    """
+    paginator = AwsClients.client("support").get_paginator("describe_communications")
+    kwargs = {"caseId": case_id}
+    if after_time:
+        kwargs["afterTime"] = after_time
+    for page in paginator.paginate(**kwargs):
+        metrics.add(DETAILS, ApiCalls=1, Retries=retry_attempts(page))
+        yield from page["communications"]
+
+
+def needs_fetch(recent_communications, complete_until):
+    """
+    The recent communications embedded by DescribeCases complete the stored
+    thread, unless there are more of them than embedded and none of them is
+    already stored.
+    """
+    if not recent_communications.get("nextToken"):
+        return False
+    if complete_until is None:
+        return True
+    return all(
+        communication["timeCreated"] > complete_until
+        for communication in recent_communications.get("communications", [])
+    )
+
+
+def add_communication_history(
+    bucket_name, file_key, case_dict, metrics=NO_METRICS, threads=None
+):
+    """
+    Add the full communication history of a case to its document. Only the
+    communications newer than the ones of the stored document are fetched.
+
+    The document records in "latest_communication_time" the time up to which
+    its thread is complete, so a thread that couldn't be fetched is completed
+    by the next run.
+
+    :param bucket_name: The S3 bucket holding the case documents.
+    :param file_key: The key of the case document.
+    :param case_dict: The case dictionary, updated in place.
+    :param metrics: The CollectorMetrics recording the details phase.
+    :param threads: The CommunicationThreads of the run, or None to read the
+        stored document of the case.
+    :return: The case dictionary.
+    """
+    with metrics.timer(DETAILS, Items=1):
+        complete_communications(bucket_name, file_key, case_dict, metrics, threads)
+    if threads is not None:
+        threads.note(file_key, case_dict["latest_communication_time"])
+    return case_dict
+
+
+def stored_thread(bucket_name, file_key, recent_communications, metrics, threads=None):
+    """
+    Get the time up to which the stored thread of a case is complete, and
+    the stored communications needed to complete it.
+    """
+    if threads is not None:
+        complete_until = threads.complete_until(file_key)
+        # The embedded communications are the whole thread, unless paginated
+        if complete_until is None or not recent_communications.get("nextToken"):
+            return complete_until, []
+
+    metrics.add(DETAILS, ApiCalls=1)
+    try:
+        if threads is None:
+            stored = load_stored_case(bucket_name, file_key) or {}
+            return stored.get("latest_communication_time"), stored.get("communications", [])
+        communications = threads.stored_communications(file_key)
+    except ClientError as err:
+        # Fetched again in full, as if the case had never been stored
+        logger.error("Couldn't load the stored case %s: %s", file_key, err)
+        return None, []
+    if communications is None:
+        return None, []
+    return complete_until, communications
+
+
+def complete_communications(bucket_name, file_key, case_dict, metrics, threads=None):
+    case = case_dict["case"]
+    recent_communications = case.get("recentCommunications", {})
+    complete_until, communications = stored_thread(
+        bucket_name, file_key, recent_communications, metrics, threads
+    )
+
+    communications = communications + recent_communications.get("communications", [])
+    complete = True
+    if needs_fetch(recent_communications, complete_until):
+        try:
+            communications.extend(
+                iter_communications(case["caseId"], complete_until, metrics)
+            )
+        except ClientError as err:
+            logger.error(
+                "Couldn't describe the communications of case %s: %s",
+                case["displayId"],
+                err,
+            )
+            complete = False
+            metrics.add(DETAILS, Failures=1)
+
+    thread = {communication_id(c): c for c in communications}
+    case_dict["communications"] = sorted(
+        thread.values(), key=lambda c: c["timeCreated"], reverse=True
+    )
+    case_dict["latest_communication_time"] = (
+        max(c["timeCreated"] for c in thread.values())
+        if complete and thread
+        else complete_until
+    )
+    return case_dict
+
+
+def with_communication_history(
+    bucket_name,
+    case_documents,
+    concurrency=COMMUNICATIONS_FETCH_CONCURRENCY,
+    metrics=NO_METRICS,
+    threads=None,
+):
+    """
+    Add the communication history to a stream of cases, fetching the threads
+    of several cases concurrently while preserving their order.
+
+    :param bucket_name: The S3 bucket holding the case documents.
+    :param case_documents: An iterable of (file_key, case_dict) tuples.
+    :param concurrency: The maximum number of threads fetched in parallel.
+    :param metrics: The CollectorMetrics recording the details phase.
+    :param threads: The CommunicationThreads of the run, or None to read the
+        stored document of each case.
+    :return: A generator of the (file_key, case_dict) tuples.
+    """
+
+    def add(file_key, case_dict):
+        return file_key, add_communication_history(
+            bucket_name, file_key, case_dict, metrics, threads
+        )
+
+    with ContextThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = deque()
+        for file_key, case_dict in case_documents:
+            if len(in_flight) >= concurrency:
+                yield in_flight.popleft().result()
+            in_flight.append(executor.submit(add, file_key, case_dict))
+        while in_flight:
+            yield in_flight.popleft().result()
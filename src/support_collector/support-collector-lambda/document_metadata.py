@@ -0,0 +1,42 @@
+from serialization import dumps
+
+# The metadata files mirror the document keys under their own prefix, set as
+# the metadata files prefix of the Amazon Q Business S3 data source. They are
+# kept out of support-cases/, which triggers the case metadata function, and
+# out of metadata/, which holds its CSV tables.
+METADATA_PREFIX = "qbusiness-metadata"
+METADATA_SUFFIX = ".metadata.json"
+
+
+def metadata_key(file_key):
+    """
+    Get the key of the metadata file of a document, e.g. the metadata of
+    ta/{account}/{checkId}.json is stored in
+    qbusiness-metadata/ta/{account}/{checkId}.json.metadata.json
+    """
+    return f"{METADATA_PREFIX}/{file_key}{METADATA_SUFFIX}"
+
+
+def is_metadata_key(file_key):
+    return file_key.startswith(METADATA_PREFIX + "/")
+
+
+def metadata_document(file_key, title, attributes):
+    """
+    Build the metadata file of a document, in the format of the Amazon Q
+    Business S3 connector, so the retrievals can filter on its attributes.
+
+    :param file_key: The S3 key of the document.
+    :param title: The title of the document.
+    :param attributes: The attributes of the document: strings, or dates in
+        ISO 8601. The attributes without a value are left out.
+    :return: The S3 key and the JSON body of the metadata file.
+    """
+    metadata = {
+        "Title": title,
+        "ContentType": "JSON",
+        "Attributes": {
+            name: value for name, value in attributes.items() if value is not None
+        },
+    }
+    return metadata_key(file_key), dumps(metadata)
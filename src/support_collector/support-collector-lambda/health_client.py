@@ -1,7 +1,21 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
-from region_lookup import active_region
-import boto3
+import logging
+import threading
+import time
+from botocore.exceptions import BotoCoreError, ClientError
+
+from region_lookup import RegionLookupError, active_region_with_ttl
+from clients import AwsClients
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Region used, and time the lookup is cached, when the active region can't be resolved
+DEFAULT_ACTIVE_REGION = "us-east-1"
+LOOKUP_FAILURE_TTL = 60
+# Region switches followed during a single call
+MAX_REGION_SWITCHES = 2
 
 
 class ActiveRegionHasChangedError(Exception):
@@ -12,32 +26,99 @@ class ActiveRegionHasChangedError(Exception):
 
 class HealthClient:
     __active_region = None
-    __client = None
+    __expires_at = 0
+    __lock = threading.Lock()
+
+    @staticmethod
+    def __lookup_active_region():
+        """Resolve the active region, cached for the TTL of the DNS record."""
+        try:
+            region_name, ttl = active_region_with_ttl()
+        except RegionLookupError as err:
+            logger.warning("%s, using %s", err, HealthClient.__active_region or DEFAULT_ACTIVE_REGION)
+            region_name = HealthClient.__active_region or DEFAULT_ACTIVE_REGION
+            ttl = LOOKUP_FAILURE_TTL
+        HealthClient.__expires_at = time.monotonic() + ttl
+        return region_name
 
     @staticmethod
     def client():
-        if not HealthClient.__active_region:
-            HealthClient.__active_region = active_region()
-        else:
-            current_active_region = active_region()
-            if current_active_region != HealthClient.__active_region:
+        with HealthClient.__lock:
+            if time.monotonic() >= HealthClient.__expires_at:
+                current_active_region = HealthClient.__lookup_active_region()
                 old_active_region = HealthClient.__active_region
                 HealthClient.__active_region = current_active_region
 
-                if HealthClient.__client:
-                    HealthClient.__client = None
+                if old_active_region and current_active_region != old_active_region:
+                    raise ActiveRegionHasChangedError(
+                        "Active region has changed from ["
+                        + old_active_region
+                        + "] to ["
+                        + current_active_region
+                        + "]"
+                    )
+
+            active_region = HealthClient.__active_region
 
-                raise ActiveRegionHasChangedError(
-                    "Active region has changed from ["
-                    + old_active_region
-                    + "] to ["
-                    + current_active_region
-                    + "]"
-                )
+        # The client of the active region is shared through the registry, with
+        # the credentials of the account collected by the thread
+        return AwsClients.client("health", region_name=active_region)
 
-        if not HealthClient.__client:
-            HealthClient.__client = boto3.client(
-                "health", region_name=HealthClient.__active_region
+    @staticmethod
+    def active_region_has_changed():
+        """Look up the active region again, ignoring the cached lookup."""
+        with HealthClient.__lock:
+            HealthClient.__expires_at = 0
+        try:
+            HealthClient.client()
+        except ActiveRegionHasChangedError:
+            return True
+        return False
+
+
+def call_health(operation_name, **kwargs):
+    """
+    Call an AWS Health API operation in the active region. When the active
+    region switches, the call is made again in the new active region.
+
+    :param operation_name: The client method name, e.g. "describe_events".
+    :return: The response of the operation.
+    """
+    for _ in range(MAX_REGION_SWITCHES):
+        try:
+            return getattr(HealthClient.client(), operation_name)(**kwargs)
+        except ActiveRegionHasChangedError as err:
+            logger.warning("%s, calling %s in the new region", err, operation_name)
+        except (BotoCoreError, ClientError) as err:
+            # The call may have failed because of a switch not seen yet by the cached lookup
+            if not HealthClient.active_region_has_changed():
+                raise
+            logger.warning(
+                "%s failed after a switch of the active region (%s), calling it in the new region",
+                operation_name,
+                err,
             )
+    return getattr(HealthClient.client(), operation_name)(**kwargs)
+
+
+class HealthPaginator:
+    """
+    Paginate an AWS Health API operation like a boto3 paginator, but with
+    each page requested through call_health, so that after a switch of the
+    active region the pagination resumes from the last page in the new region.
+    """
+
+    def __init__(self, operation_name):
+        self.operation_name = operation_name
 
-        return HealthClient.__client
+    def paginate(self, **kwargs):
+        pagination_config = kwargs.pop("PaginationConfig", {})
+        next_token = pagination_config.get("StartingToken")
+        while True:
+            if next_token:
+                kwargs["nextToken"] = next_token
+            page = call_health(self.operation_name, **kwargs)
+            yield page
+            next_token = page.get("nextToken")
+            if not next_token:
+                return
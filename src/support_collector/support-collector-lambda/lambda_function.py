@@ -1,5 +1,58 @@
 import importlib
+import json
 import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from backfill import TimeBudget, invoke_accounts_continuation, invoke_continuation
+from clients import AwsClients
+from member_accounts import collect_accounts, get_account_concurrency, list_member_accounts
+from metrics import emit_api_metrics
+from partitions import DOCUMENTS, OUTPUT_FORMATS
+from rate_limiter import ApiRateLimits
+from s3_uploader import get_upload_concurrency
+
+COLLECTOR_FLAGS = ("case", "ta", "health")
+
+
+def upload_cases_on_case_events_batch(event, account_id):
+    """
+    Process a batch of Support Case Update events delivered by Amazon SQS.
+    The events of the same case are collapsed, so each case is fetched and
+    uploaded once, and only the messages of the failed cases are redelivered.
+    """
+    bucket_name = os.environ['S3_BUCKET_NAME']
+    bulk_upload_cases = importlib.import_module("upload_cases")
+
+    batch_item_failures = []
+    message_ids_by_case = defaultdict(list)
+    for record in event["Records"]:
+        try:
+            case_id = json.loads(record["body"])["detail"]["display-id"]
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Invalid support case event in message {record['messageId']}: {str(e)}")
+            batch_item_failures.append({"itemIdentifier": record["messageId"]})
+            continue
+        message_ids_by_case[case_id].append(record["messageId"])
+
+    print(
+        f"Processing {len(event['Records'])} support case events "
+        f"for {len(message_ids_by_case)} cases"
+    )
+    errors = bulk_upload_cases.upload_cases_by_id_to_s3(
+        bucket_name, account_id, list(message_ids_by_case)
+    )
+    for case_id, error in errors.items():
+        if error:
+            print(f"Error processing support case {case_id}: {error}")
+            batch_item_failures.extend(
+                {"itemIdentifier": message_id}
+                for message_id in message_ids_by_case[case_id]
+            )
+
+    return {"batchItemFailures": batch_item_failures}
+
 
 def upload_case_on_case_event(event, account_id):
     try:
@@ -43,7 +96,305 @@ def upload_case_on_case_event(event, account_id):
         }
 
 
-def upload_case_on_scheduler_run(event, account_id):
+def format_upload_report(report):
+    message = (
+        f"{len(report['succeeded'])} uploaded, {len(report['failed'])} failed, "
+        f"{len(report.get('skipped', []))} unchanged."
+    )
+    if report["failed"]:
+        failed_keys = ", ".join(failure["key"] for failure in report["failed"])
+        message += f" Failed keys: {failed_keys}"
+    return message
+
+
+def run_collector(name, description, collect):
+    """
+    Run a collector, isolating its failure from the other collectors.
+
+    :return: Whether the collector succeeded, its response message with its
+        wall time, and the state to resume it if it ran out of time.
+    """
+    print(description)
+    started = time.monotonic()
+    try:
+        report = collect()
+        elapsed = time.monotonic() - started
+        status = "upload interrupted" if report.get("continuation") else "upload complete"
+        message = f"{name} {status} in {elapsed:.1f}s. {format_upload_report(report)}"
+        return True, f"{description}\n{message}", report.get("continuation")
+    except Exception as e:
+        elapsed = time.monotonic() - started
+        message = f"{name} upload failed after {elapsed:.1f}s: {str(e)}"
+        print(message)
+        return False, f"{description}\n{message}", None
+
+
+def emit_rate_limit_metrics(account_id):
+    """Emit the API metrics of the run, per collected account."""
+    for api_account_id, api_stats in ApiRateLimits.collect_stats().items():
+        emit_api_metrics(api_account_id or account_id, api_stats)
+
+
+def run_collectors(collectors, upload_concurrency, account_id):
+    """
+    Run the collectors concurrently.
+
+    :param collectors: A list of (flag, name, description, collect) tuples.
+    :return: The Lambda response, and the continuation states of the
+        interrupted collectors keyed by flag.
+    """
+    # The collectors use different APIs and S3 prefixes, so they run
+    # concurrently and share an S3 connection pool sized for all of them
+    AwsClients.client("s3", max_pool_connections=upload_concurrency * len(collectors))
+    ApiRateLimits.collect_stats()
+    with ThreadPoolExecutor(max_workers=len(collectors)) as executor:
+        results = list(
+            executor.map(lambda collector: run_collector(*collector[1:]), collectors)
+        )
+    emit_rate_limit_metrics(account_id)
+
+    response_messages = [message for _, message, _ in results]
+    continuations = {
+        collector[0]: continuation
+        for collector, (_, _, continuation) in zip(collectors, results)
+        if continuation
+    }
+    status_code = 200 if all(succeeded for succeeded, _, _ in results) else 500
+    response = {"statusCode": status_code, "body": "\n".join(response_messages)}
+    return response, continuations
+
+
+def get_collectors(event, account_id, upload_concurrency, context=None):
+    """
+    Get the collectors enabled by the flags of a scheduler event.
+
+    :return: A list of (flag, name, description, collect) tuples.
+    """
+    bucket_name = event["bucket_name"]
+    past_no_of_days = event["past_no_of_days"]
+    incremental = event.get("incremental", True)
+    output_format = event.get("output_format", DOCUMENTS)
+
+    # Historical backfills stop before the Lambda timeout and resume in a new invocation
+    time_budget = TimeBudget(context) if context else None
+    continuation = event.get("continuation", {})
+
+    # Check each flag and collect the corresponding scripts
+    collectors = []
+
+    if event.get("case", False):
+        bulk_upload_cases = importlib.import_module("upload_cases")
+        collectors.append(
+            (
+                "case",
+                "Cases",
+                "Searching AWS Support Cases..",
+                lambda: bulk_upload_cases.upload_all_cases_to_s3(
+                    bucket_name,
+                    past_no_of_days,
+                    account_id,
+                    upload_concurrency,
+                    incremental=incremental,
+                    output_format=output_format,
+                    time_budget=time_budget,
+                    continuation_state=continuation.get("case"),
+                ),
+            )
+        )
+
+    if event.get("ta", False):
+        bulk_upload_ta = importlib.import_module("upload_ta")
+        collectors.append(
+            (
+                "ta",
+                "Trusted Advisor recommendations",
+                "Searching AWS Trusted Advisor recommendations..",
+                lambda: bulk_upload_ta.upload_all_recommendations_to_s3(
+                    bucket_name,
+                    account_id,
+                    upload_concurrency,
+                    output_format=output_format,
+                    incremental=incremental,
+                ),
+            )
+        )
+
+    if event.get("health", False):
+        bulk_upload_health = importlib.import_module("upload_health")
+        collectors.append(
+            (
+                "health",
+                "Health events",
+                "Searching AWS Health notifications..",
+                lambda: bulk_upload_health.upload_health_events_to_s3(
+                    bucket_name,
+                    past_no_of_days,
+                    account_id,
+                    upload_concurrency,
+                    incremental=incremental,
+                    output_format=output_format,
+                    time_budget=time_budget,
+                    continuation_state=continuation.get("health"),
+                    organization=event.get("organization_health", False),
+                ),
+            )
+        )
+
+    return collectors
+
+
+def account_run_event(event, account_states):
+    """
+    Get the scheduler event of a member account: the event itself, or only
+    the collectors left to run when the account is resumed.
+
+    :param account_states: The saved states of the account keyed by
+        collector flag, or None if the account wasn't started.
+    """
+    if account_states is None:
+        return dict(event, continuation={})
+    account_event = dict(event, case=False, health=False, ta=False)
+    account_event.update({flag: True for flag in account_states})
+    account_event["continuation"] = {
+        flag: state for flag, state in account_states.items() if state
+    }
+    return account_event
+
+
+def accounts_response(event, results, pending):
+    """
+    Build the response of a run over the member accounts.
+
+    :param results: The (collector results, error) of each collected account.
+    :param pending: The accounts that weren't started.
+    :return: The Lambda response, and the continuation states keyed by
+        account ID, then by collector flag.
+    """
+    continuation = event.get("continuation", {})
+    response_messages = []
+    continuations = {}
+    succeeded = True
+    for account_id, (collector_results, error) in results.items():
+        if error:
+            response_messages.append(f"Account {account_id}: {error}")
+            succeeded = False
+            continue
+        response_messages.append(f"Account {account_id}:")
+        for flag, collector_succeeded, message, state in collector_results:
+            response_messages.append(message)
+            succeeded = succeeded and collector_succeeded
+            if state:
+                continuations.setdefault(account_id, {})[flag] = state
+    if pending:
+        response_messages.append(f"{len(pending)} accounts left for a new invocation.")
+    for account_id in pending:
+        continuations[account_id] = continuation.get(account_id) or {
+            flag: None for flag in COLLECTOR_FLAGS if event.get(flag)
+        }
+
+    response = {
+        "statusCode": 200 if succeeded else 500,
+        "body": "\n".join(response_messages),
+    }
+    return response, continuations
+
+
+def upload_on_accounts_run(event, account_id, upload_concurrency, context=None):
+    """
+    Collect the member accounts from a central deployment, assuming the
+    collector role of each account. The accounts are collected concurrently,
+    up to account_concurrency at a time, each one running its collectors one
+    after the other, and their documents are written under their own account
+    ID. The accounts left when the time budget expires are collected by a
+    new invocation.
+    """
+    account_ids = event.get("accounts") or list_member_accounts()
+    account_concurrency = get_account_concurrency(event.get("account_concurrency"))
+    continuation = event.get("continuation", {})
+    print(f"Collecting {len(account_ids)} accounts, {account_concurrency} at a time")
+
+    def collect_account(member_account_id):
+        account_event = account_run_event(event, continuation.get(member_account_id))
+        collectors = get_collectors(
+            account_event, member_account_id, upload_concurrency, context
+        )
+        return [
+            (collector[0], *run_collector(*collector[1:])) for collector in collectors
+        ]
+
+    # The accounts in flight share the S3 connection pool
+    AwsClients.client(
+        "s3", max_pool_connections=upload_concurrency * account_concurrency
+    )
+    ApiRateLimits.collect_stats()
+    results, pending = collect_accounts(
+        account_ids,
+        collect_account,
+        role_name=event["member_role_name"],
+        own_account_id=account_id,
+        concurrency=account_concurrency,
+        time_budget=TimeBudget(context) if context else None,
+    )
+    emit_rate_limit_metrics(account_id)
+
+    response, continuations = accounts_response(event, results, pending)
+    if continuations:
+        invoke_accounts_continuation(context, event, continuations)
+    return response
+
+
+def check_accounts_options(event):
+    """
+    Check the parameters of a run over the member accounts.
+
+    :return: The error message of the first invalid parameter, or None.
+    """
+    try:
+        get_account_concurrency(event.get("account_concurrency"))
+    except (TypeError, ValueError):
+        return "Error: account_concurrency parameter must be an integer."
+
+    accounts = event.get("accounts")
+    if accounts is not None and not (
+        isinstance(accounts, list)
+        and all(isinstance(account, str) and account.isdigit() for account in accounts)
+    ):
+        return "Error: accounts parameter must be a list of account IDs."
+
+    if event.get("member_role_name") and event.get("organization_health"):
+        return "Error: organization_health parameter can't be combined with member_role_name."
+
+    return None
+
+
+def check_run_options(event):
+    """
+    Check the optional parameters of a scheduler event, and apply the API
+    rates of the run.
+
+    :return: The error message of the first invalid parameter, or None.
+    """
+    try:
+        get_upload_concurrency(event.get("upload_concurrency"))
+    except (TypeError, ValueError):
+        return "Error: upload_concurrency parameter must be an integer."
+
+    error = check_accounts_options(event)
+    if error:
+        return error
+
+    if event.get("output_format", DOCUMENTS) not in OUTPUT_FORMATS:
+        return f"Error: output_format parameter must be one of {', '.join(OUTPUT_FORMATS)}."
+
+    try:
+        ApiRateLimits.configure(event.get("api_rates") or {})
+    except (AttributeError, ValueError):
+        return "Error: api_rates parameter must map API names to positive requests per second."
+
+    return None
+
+
+def upload_case_on_scheduler_run(event, account_id, context=None):
     # Handle scheduled runs (using event parameters)
     bucket_name = event.get("bucket_name")
     if not bucket_name:
@@ -70,40 +421,30 @@ def upload_case_on_scheduler_run(event, account_id):
             "body": "Error: No scripts specified to run. Please provide at least one flag ('case', 'health', 'ta').",
         }
 
-    # Check each flag and run the corresponding script
-    response_messages = []
+    error = check_run_options(event)
+    if error:
+        return {"statusCode": 400, "body": error}
 
-    if run_case:
-        bulk_upload_cases = importlib.import_module("upload_cases")
-        response_messages.append("Searching AWS Support Cases..")
-        bulk_upload_cases.upload_all_cases_to_s3(
-            bucket_name, past_no_of_days, account_id
-        )
-        response_messages.append("Cases uploaded successfully.")
+    upload_concurrency = get_upload_concurrency(event.get("upload_concurrency"))
+    if event.get("member_role_name"):
+        return upload_on_accounts_run(event, account_id, upload_concurrency, context)
 
-    if run_ta:
-        bulk_upload_ta = importlib.import_module("upload_ta")
-        response_messages.append("Searching AWS Trusted Advisor recommendations..")
-        bulk_upload_ta.upload_all_recommendations_to_s3(bucket_name, account_id)
-        response_messages.append(
-            "Trusted Advisor recommendations uploaded successfully."
-        )
+    collectors = get_collectors(event, account_id, upload_concurrency, context)
+    response, continuations = run_collectors(collectors, upload_concurrency, account_id)
+    if continuations:
+        invoke_continuation(context, event, continuations)
+    return response
 
-    if run_health:
-        bulk_upload_health = importlib.import_module("upload_health")
-        response_messages.append("Searching AWS Health notifications..")
-        bulk_upload_health.upload_health_events_to_s3(
-            bucket_name, past_no_of_days, account_id
-        )
-        response_messages.append("Health events uploaded successfully.")
-
-    return {"statusCode": 200, "body": "\n".join(response_messages)}
 
 def lambda_handler(event, context):
     account_id = context.invoked_function_arn.split(":")[4]
 
+    # Check if this is a batch of Support Case Update events from the SQS queue
+    if event.get("Records") and event["Records"][0].get("eventSource") == "aws:sqs":
+        return upload_cases_on_case_events_batch(event, account_id)
+
     # Check if this is a Support Case Update event
     if event.get('source') == 'aws.support' and event.get('detail-type') == 'Support Case Update':
         return upload_case_on_case_event(event, account_id)
 
-    return upload_case_on_scheduler_run(event, account_id)
+    return upload_case_on_scheduler_run(event, account_id, context)
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import threading
+from datetime import datetime, timezone
+
+from checkpoint import CHECKPOINT_PREFIX
+from document_metadata import METADATA_PREFIX
+from s3_uploader import read_state
+from storage import storage_sink
+
+
+def manifest_key(account_id, collector):
+    return f"{CHECKPOINT_PREFIX}/{account_id}/{collector}-manifest.json"
+
+
+def content_hash(body):
+    """Get the hash of a document body, as serialized before its content encoding."""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def document_account(file_key):
+    # The document keys are "<prefix>/<account_id>/...", e.g. ta/{account}/{checkId}.json,
+    # and the keys of their metadata files are under METADATA_PREFIX
+    parts = file_key.split("/")
+    return parts[2] if parts[0] == METADATA_PREFIX else parts[1]
+
+
+class DocumentManifest:
+    """
+    Content hashes of the documents uploaded by a collector, stored per
+    account next to its checkpoint, so the documents that didn't change since
+    the last run are not uploaded again.
+
+    The manifest of an account is loaded when the first of its documents is
+    written, and only records the documents whose upload succeeded.
+
+    :param bucket_name: The S3 bucket holding the support data.
+    :param collector: The collector name, e.g. "cases" or "health".
+    :param incremental: False to upload all the documents, whatever their
+        stored hashes.
+    """
+
+    def __init__(self, bucket_name, collector, incremental=True):
+        self.bucket_name = bucket_name
+        self.collector = collector
+        self.incremental = incremental
+        self.__hashes = {}
+        self.__pending = {}
+        self.__changed_accounts = set()
+        self.__lock = threading.Lock()
+
+    def account_hashes(self, account_id):
+        with self.__lock:
+            if account_id in self.__hashes:
+                return self.__hashes[account_id]
+        body = read_state(self.bucket_name, manifest_key(account_id, self.collector))
+        hashes = json.loads(body.decode("utf-8"))["documents"] if body is not None else {}
+        with self.__lock:
+            return self.__hashes.setdefault(account_id, hashes)
+
+    def changed_documents(self, documents, skipped):
+        """
+        Filter a stream of (file_key, body) documents down to the ones whose
+        content changed since their last upload.
+
+        :param skipped: A list to which the keys of the unchanged documents are added.
+        """
+        for file_key, body in documents:
+            digest = content_hash(body)
+            stored_digest = self.account_hashes(document_account(file_key)).get(file_key)
+            if self.incremental and stored_digest == digest:
+                skipped.append(file_key)
+                continue
+            with self.__lock:
+                self.__pending[file_key] = digest
+            yield file_key, body
+
+    def record(self, report):
+        """Record the hashes of the documents uploaded successfully."""
+        with self.__lock:
+            for file_key in report["succeeded"]:
+                digest = self.__pending.pop(file_key, None)
+                if digest is not None:
+                    account_id = document_account(file_key)
+                    self.__hashes[account_id][file_key] = digest
+                    self.__changed_accounts.add(account_id)
+            self.__pending.clear()
+
+    def save(self):
+        """Store the manifests of the accounts with new uploads."""
+        for account_id in sorted(self.__changed_accounts):
+            state = {
+                "account_id": account_id,
+                "collector": self.collector,
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+                "documents": self.__hashes[account_id],
+            }
+            storage_sink(self.bucket_name).put(
+                manifest_key(account_id, self.collector),
+                json.dumps(state).encode("utf-8"),
+            )
+        self.__changed_accounts.clear()
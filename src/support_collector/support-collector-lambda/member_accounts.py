@@ -0,0 +1,96 @@
+import logging
+from botocore.exceptions import BotoCoreError, ClientError
+
+from clients import AssumedRoles, AwsClients, ContextThreadPoolExecutor, collected_role, session
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DEFAULT_ACCOUNT_CONCURRENCY = 5
+MAX_ACCOUNT_CONCURRENCY = 50
+DEFAULT_PARTITION = "aws"
+
+
+def get_account_concurrency(value):
+    """
+    Normalize the account concurrency coming from the scheduler event payload.
+
+    :param value: The requested number of accounts collected in parallel, or None.
+    :return: The concurrency to use, between 1 and MAX_ACCOUNT_CONCURRENCY.
+    """
+    if value is None:
+        return DEFAULT_ACCOUNT_CONCURRENCY
+    return max(1, min(int(value), MAX_ACCOUNT_CONCURRENCY))
+
+
+def member_role_arn(account_id, role_name):
+    partition = DEFAULT_PARTITION
+    if session.region_name:
+        partition = session.get_partition_for_region(session.region_name)
+    return f"arn:{partition}:iam::{account_id}:role/{role_name}"
+
+
+def list_member_accounts():
+    """List the IDs of the active accounts of the organization."""
+    paginator = AwsClients.client("organizations").get_paginator("list_accounts")
+    return [
+        account["Id"]
+        for page in paginator.paginate()
+        for account in page["Accounts"]
+        if account["Status"] == "ACTIVE"
+    ]
+
+
+def collect_accounts(
+    account_ids,
+    collect_account,
+    *,
+    role_name,
+    own_account_id,
+    concurrency=DEFAULT_ACCOUNT_CONCURRENCY,
+    time_budget=None,
+):
+    """
+    Collect several accounts concurrently from a bounded pool of workers.
+    Each account is collected in the context of the role assumed in it, so
+    its Support and Health clients use the cached credentials of the role.
+
+    :param account_ids: The IDs of the accounts to collect.
+    :param collect_account: The function collecting an account, called with
+        its ID.
+    :param role_name: The name of the collector role in the member accounts.
+    :param own_account_id: The account of the Lambda function, collected
+        with its own credentials.
+    :param concurrency: The maximum number of accounts collected in parallel.
+    :param time_budget: The TimeBudget of the invocation: the accounts are
+        no longer started once it has expired.
+    :return: The (result, error) of each collected account keyed by account
+        ID, and the IDs of the accounts that weren't started.
+    """
+
+    def collect(account_id):
+        if time_budget and time_budget.expired():
+            return None
+        role_arn = None
+        if account_id != own_account_id:
+            role_arn = member_role_arn(account_id, role_name)
+            try:
+                # Fail the account once if its role can't be assumed
+                AssumedRoles.credentials(role_arn)
+            except (BotoCoreError, ClientError) as err:
+                logger.error("Couldn't assume %s: %s", role_arn, err)
+                return None, f"Couldn't assume {role_arn}: {err}"
+        # Each task runs in its own copy of the context of the pool
+        collected_role.set(role_arn)
+        return collect_account(account_id), None
+
+    with ContextThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = dict(zip(account_ids, executor.map(collect, account_ids)))
+
+    results = {
+        account_id: outcome
+        for account_id, outcome in outcomes.items()
+        if outcome is not None
+    }
+    pending = [account_id for account_id, outcome in outcomes.items() if outcome is None]
+    return results, pending
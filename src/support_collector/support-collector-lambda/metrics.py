@@ -0,0 +1,174 @@
+import json
+import os
+import random
+import threading
+import time
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+METRICS_NAMESPACE = "SupportInsights/Collectors"
+
+# Phases of a collector run
+LIST = "list"
+DETAILS = "details"
+SERIALIZE = "serialize"
+UPLOAD = "upload"
+
+# Metrics recorded for each phase, with their CloudWatch unit
+PHASE_METRICS = {
+    "DurationMs": "Milliseconds",
+    "ApiCalls": "Count",
+    "Items": "Count",
+    "Bytes": "Bytes",
+    "Retries": "Count",
+    "Failures": "Count",
+    "Skipped": "Count",
+}
+API_METRICS = {
+    "ApiCalls": "Count",
+    "Throttles": "Count",
+    "RateLimitWaitMs": "Milliseconds",
+}
+
+# Fraction of the per-object debug messages that are logged
+DEBUG_LOG_SAMPLE_RATE = float(os.environ.get("DEBUG_LOG_SAMPLE_RATE", "0.01"))
+
+
+def log_sampled(message, *args):
+    """
+    Log a per-object debug message, for a sample of the objects only. The
+    messages are logged at the INFO level the modules set on the root
+    logger, the sampling keeping their volume down.
+    """
+    if random.random() < DEBUG_LOG_SAMPLE_RATE:
+        logger.info(message, *args)
+
+
+def retry_attempts(response):
+    """Get the retries made by botocore to get a response."""
+    return response.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+
+
+def emf_record(dimensions, metric_units, values):
+    """Build a CloudWatch Embedded Metric Format log record."""
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [
+                        # Aggregated over the accounts, and per account
+                        [name for name in dimensions if name != "AccountId"],
+                        list(dimensions),
+                    ],
+                    "Metrics": [
+                        {"Name": name, "Unit": unit}
+                        for name, unit in metric_units.items()
+                    ],
+                }
+            ],
+        },
+        **dimensions,
+        **{name: values.get(name, 0) for name in metric_units},
+    }
+
+
+class CollectorMetrics:
+    """
+    Metrics of the phases of a collector run (list, details, serialize and
+    upload), shared by the threads of the run and emitted in CloudWatch
+    Embedded Metric Format once the run is over.
+
+    The duration of a phase is the time spent in it summed over the threads.
+
+    :param collector: The collector name, e.g. "cases", or None to record
+        nothing, when a function is called outside of a collector run.
+    :param account_id: The account of the collected data.
+    """
+
+    def __init__(self, collector=None, account_id=None):
+        self.collector = collector
+        self.account_id = account_id
+        self.__phases = defaultdict(lambda: defaultdict(float))
+        self.__lock = threading.Lock()
+
+    def add(self, phase, **values):
+        """Add values to the metrics of a phase, e.g. add(LIST, ApiCalls=1, Items=100)."""
+        if self.collector is None:
+            return
+        with self.__lock:
+            for name, value in values.items():
+                self.__phases[phase][name] += value
+
+    @contextmanager
+    def timer(self, phase, **values):
+        """Add the duration of a block, and the given values, to a phase."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(
+                phase, DurationMs=(time.perf_counter() - started) * 1000, **values
+            )
+
+    def serialize(self, serialize_document, items, serialize_metadata=None):
+        """
+        Serialize a stream of items into (file_key, body) documents, recording
+        the serialize phase. The items are pulled lazily, so the time spent to
+        list or detail them is not part of the phase.
+
+        :param serialize_metadata: The function building the metadata file of
+            an item, yielded after its document, or None.
+        """
+        for item in items:
+            started = time.perf_counter()
+            documents = [serialize_document(item)]
+            if serialize_metadata is not None:
+                documents.append(serialize_metadata(item))
+            self.add(
+                SERIALIZE,
+                DurationMs=(time.perf_counter() - started) * 1000,
+                Items=1,
+                Bytes=sum(len(body) for _, body in documents),
+            )
+            yield from documents
+
+    def emit(self):
+        """Print one EMF record per phase."""
+        if self.collector is None:
+            return
+        with self.__lock:
+            phases = {phase: dict(values) for phase, values in self.__phases.items()}
+        for phase, values in phases.items():
+            dimensions = {
+                "AccountId": self.account_id,
+                "Collector": self.collector,
+                "Phase": phase,
+            }
+            print(json.dumps(emf_record(dimensions, PHASE_METRICS, values)))
+
+
+# Default of the functions called outside of a collector run
+NO_METRICS = CollectorMetrics()
+
+
+def emit_api_metrics(account_id, api_stats):
+    """
+    Print one EMF record per API with the calls, throttles and rate limit
+    wait time collected by the rate limiters.
+
+    :param api_stats: The stats returned by ApiRateLimits.collect_stats.
+    """
+    for api, stats in api_stats.items():
+        values = {
+            "ApiCalls": stats["calls"],
+            "Throttles": stats["throttles"],
+            "RateLimitWaitMs": stats["wait_seconds"] * 1000,
+        }
+        dimensions = {"AccountId": account_id, "Api": api}
+        print(json.dumps(emf_record(dimensions, API_METRICS, values)))
@@ -0,0 +1,186 @@
+import gzip
+import json
+import posixpath
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from document_metadata import is_metadata_key
+from metrics import NO_METRICS, UPLOAD
+from s3_uploader import DEFAULT_UPLOAD_CONCURRENCY, read_object, upload_documents
+from serialization import document_upload_args, encode_documents
+
+PARTITIONS_PREFIX = "partitions"
+
+# Output formats of the collectors
+DOCUMENTS = "documents"
+PARTITIONS = "partitions"
+BOTH = "both"
+OUTPUT_FORMATS = (DOCUMENTS, PARTITIONS, BOTH)
+
+
+def partition_key(file_key):
+    """
+    Get the consolidated partition of a document, e.g.
+    support-cases/{account}/{YYYY}/{MM}/{id}.json is merged into
+    partitions/support-cases/{account}/{YYYY}/{MM}.ndjson.gz and
+    ta/{account}/{checkId}.json into partitions/ta/{account}.ndjson.gz
+    """
+    return f"{PARTITIONS_PREFIX}/{posixpath.dirname(file_key)}.ndjson.gz"
+
+
+def partition_record(file_key, body):
+    # The document body is already serialized JSON, it is embedded as is
+    return b'{"key":' + json.dumps(file_key).encode("utf-8") + b',"document":' + body + b"}"
+
+
+def read_partition(bucket_name, key):
+    """Read the records of an existing partition, keyed by document key."""
+    body = read_object(bucket_name, key)
+    if body is None:
+        return {}
+
+    records = {}
+    for line in gzip.decompress(body).splitlines():
+        if line:
+            records[json.loads(line)["key"]] = line
+    return records
+
+
+def merge_partition(bucket_name, key, records):
+    """
+    Merge the records of this run into the existing partition, the new
+    version of a document replacing the stored one.
+
+    :return: The partition key and body, the body being None when the
+        records are all identical to the stored ones.
+    """
+    merged = read_partition(bucket_name, key)
+    if all(merged.get(file_key) == record for file_key, record in records.items()):
+        return key, None
+    merged.update(records)
+    return key, gzip.compress(b"\n".join(merged.values()) + b"\n")
+
+
+def changed_partitions(partitions, skipped):
+    """Filter out the unchanged merged partitions, adding their keys to skipped."""
+    for key, body in partitions:
+        if body is None:
+            skipped.append(key)
+        else:
+            yield key, body
+
+
+def upload_changed_documents(
+    bucket_name, documents, upload_concurrency, manifest=None, *, metrics=NO_METRICS
+):
+    """
+    Upload the documents in their content encoding, skipping the ones the
+    manifest has with the same content.
+
+    :return: The upload report, with the keys of the skipped documents.
+    """
+    skipped = []
+    # The manifest hashes the JSON documents, before their content encoding
+    if manifest is not None:
+        documents = manifest.changed_documents(documents, skipped)
+    documents = encode_documents(documents)
+
+    report = upload_documents(
+        bucket_name,
+        documents,
+        upload_concurrency,
+        document_upload_args(),
+        metrics=metrics,
+    )
+    if manifest is not None:
+        manifest.record(report)
+        manifest.save()
+    report["skipped"] = skipped
+    return report
+
+
+def write_documents(
+    bucket_name,
+    documents,
+    upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+    output_format=DOCUMENTS,
+    manifest=None,
+    *,
+    metrics=NO_METRICS,
+):
+    """
+    Write the documents of a collector as one object per document, as gzip
+    compressed NDJSON partitions per account and month, or both.
+
+    The partitions of a run are buffered in memory until the documents have
+    all been produced, then merged with the stored partitions. The documents
+    and partitions whose content didn't change are not uploaded again.
+
+    :param bucket_name: The S3 bucket name.
+    :param documents: An iterable of (file_key, body) tuples.
+    :param upload_concurrency: The maximum number of uploads in flight.
+    :param output_format: One of "documents", "partitions" or "both".
+    :param manifest: The DocumentManifest of the collector, or None to
+        upload all the documents.
+    :param metrics: The CollectorMetrics recording the upload phase.
+    :return: The upload report of the documents and partitions written, and
+        of the ones skipped.
+    """
+    if output_format == DOCUMENTS:
+        report = upload_changed_documents(
+            bucket_name, documents, upload_concurrency, manifest, metrics=metrics
+        )
+        metrics.add(UPLOAD, Skipped=len(report["skipped"]))
+        return report
+
+    partitions = defaultdict(dict)
+
+    def collect(documents):
+        for file_key, body in documents:
+            # The metadata files only go with the per-document objects
+            if not is_metadata_key(file_key):
+                partitions[partition_key(file_key)][file_key] = partition_record(
+                    file_key, body
+                )
+            yield file_key, body
+
+    if output_format == BOTH:
+        # The partitions embed all the documents as JSON, changed or not,
+        # before their content encoding
+        report = upload_changed_documents(
+            bucket_name,
+            collect(documents),
+            upload_concurrency,
+            manifest,
+            metrics=metrics,
+        )
+    else:
+        for _ in collect(documents):
+            pass
+        report = {"succeeded": [], "failed": [], "skipped": []}
+
+    skipped_partitions = []
+    with ThreadPoolExecutor(max_workers=upload_concurrency) as executor:
+        partition_report = upload_documents(
+            bucket_name,
+            changed_partitions(
+                executor.map(
+                    lambda partition: merge_partition(bucket_name, *partition),
+                    partitions.items(),
+                ),
+                skipped_partitions,
+            ),
+            upload_concurrency,
+            extra_args={"ContentType": "application/gzip"},
+            metrics=metrics,
+        )
+
+    report["succeeded"].extend(partition_report["succeeded"])
+    report["failed"].extend(partition_report["failed"])
+    report["skipped"].extend(skipped_partitions)
+    metrics.add(UPLOAD, Skipped=len(report["skipped"]))
+    print(
+        f"Merged {len(partitions)} partitions, "
+        f"{len(skipped_partitions)} of them unchanged"
+    )
+    return report
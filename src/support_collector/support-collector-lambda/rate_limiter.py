@@ -0,0 +1,195 @@
+import functools
+import threading
+import time
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+THROTTLING_ERROR_CODES = (
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "SlowDown",
+)
+
+# Requests per second sent to each API, keyed by service or by
+# "service.Operation" for the operations with their own quota
+DEFAULT_API_RATES = {
+    "support": 5,
+    "support.DescribeTrustedAdvisorCheckResult": 10,
+    "health": 10,
+    "s3": 500,
+}
+RATE_LIMITED_SERVICES = ("support", "health", "s3")
+
+# Adaptive slow-down: the rate is halved on throttling, then recovers by a
+# fraction of the configured rate on each successful request
+THROTTLED_RATE_FACTOR = 0.5
+RATE_RECOVERY_FACTOR = 0.05
+MIN_RATE_FACTOR = 0.05
+
+
+class RateLimiter:
+    """Token bucket shared by the threads calling the same API"""
+
+    def __init__(self, rate, burst=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        # Counters since the last collection
+        self.__stats = {"calls": 0, "throttles": 0, "wait_seconds": 0.0}
+        self.__tokens = self.burst
+        self.__updated_at = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request can be sent."""
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(
+                    self.burst, self.__tokens + (now - self.__updated_at) * self.rate
+                )
+                self.__updated_at = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    self.__stats["calls"] += 1
+                    return
+                wait = (1 - self.__tokens) / self.rate
+                self.__stats["wait_seconds"] += wait
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.__lock:
+            self.__stats["throttles"] += 1
+            self.rate = max(
+                self.max_rate * MIN_RATE_FACTOR, self.rate * THROTTLED_RATE_FACTOR
+            )
+            logger.warning("Throttled, slowing down to %.2f requests/s", self.rate)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self.__lock:
+                self.rate = min(
+                    self.max_rate, self.rate + self.max_rate * RATE_RECOVERY_FACTOR
+                )
+
+    def collect_stats(self):
+        """Get the calls, throttles and wait time since the last collection."""
+        with self.__lock:
+            stats = {
+                "calls": self.__stats["calls"],
+                "throttles": self.__stats["throttles"],
+                "wait_seconds": round(self.__stats["wait_seconds"], 3),
+                "rate": round(self.rate, 2),
+            }
+            self.__stats = {"calls": 0, "throttles": 0, "wait_seconds": 0.0}
+        return stats
+
+
+def is_throttling_error(err):
+    return err.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+
+
+class ApiRateLimits:
+    """
+    Rate limiters of the APIs, shared by all the clients of the Lambda
+    function. Every request of the clients registered with limit_client,
+    retries included, waits for a token of the limiter of its API. The
+    accounts collected with an assumed role have their own limiters, as
+    their API quotas are separate.
+    """
+
+    __rates = dict(DEFAULT_API_RATES)
+    __limiters = {}
+    __lock = threading.Lock()
+
+    @staticmethod
+    def configure(rates):
+        """
+        Set the rates of the APIs: the default rates overridden by the given
+        ones, e.g. {"support": 3, "health.DescribeEvents": 5}. The limiters
+        of the APIs whose rate changed are recreated, the others keep their
+        adaptive rate across warm invocations.
+        """
+        new_rates = dict(DEFAULT_API_RATES)
+        for api, rate in rates.items():
+            if isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate <= 0:
+                raise ValueError(f"The rate of {api} must be a positive number")
+            new_rates[api] = rate
+
+        with ApiRateLimits.__lock:
+            for key, limiter in list(ApiRateLimits.__limiters.items()):
+                if new_rates.get(key[1]) != limiter.max_rate:
+                    del ApiRateLimits.__limiters[key]
+            ApiRateLimits.__rates = new_rates
+
+    @staticmethod
+    def limiter(service, operation, account_id=None):
+        api = f"{service}.{operation}"
+        if api not in ApiRateLimits.__rates:
+            api = service
+        key = (account_id, api)
+        with ApiRateLimits.__lock:
+            if key not in ApiRateLimits.__limiters:
+                ApiRateLimits.__limiters[key] = RateLimiter(ApiRateLimits.__rates[api])
+            return ApiRateLimits.__limiters[key]
+
+    @staticmethod
+    def collect_stats():
+        """
+        Get the calls, throttles and wait time of each API since the last
+        collection, keyed by account ID, None being the account of the
+        Lambda function.
+        """
+        with ApiRateLimits.__lock:
+            limiters = dict(ApiRateLimits.__limiters)
+        stats = {}
+        for (account_id, api), limiter in limiters.items():
+            stats.setdefault(account_id, {})[api] = limiter.collect_stats()
+        return stats
+
+
+def api_of_event(event_name):
+    # Event names are "<event>.<service>.<Operation>"
+    _, service, operation = event_name.split(".", 2)
+    return service, operation
+
+
+def before_send(event_name, account_id=None, **_kwargs):
+    ApiRateLimits.limiter(*api_of_event(event_name), account_id).acquire()
+
+
+def after_attempt(event_name, response=None, account_id=None, **_kwargs):
+    if response is None:
+        return
+    limiter = ApiRateLimits.limiter(*api_of_event(event_name), account_id)
+    if is_throttling_error(response[1]):
+        limiter.throttled()
+    elif response[0].status_code < 400:
+        limiter.succeeded()
+
+
+def limit_client(client, account_id=None):
+    """
+    Send the requests of a client through the rate limiters of its API.
+
+    :param account_id: The account collected with an assumed role, to use
+        its own limiters, or None for the account of the Lambda function.
+    """
+    service = client.meta.service_model.service_id.hyphenize()
+    if service in RATE_LIMITED_SERVICES:
+        client.meta.events.register(
+            f"before-send.{service}",
+            functools.partial(before_send, account_id=account_id),
+            unique_id="rate-limiter-before-send",
+        )
+        # Registered first to see every attempt, whatever the retry handler decides
+        client.meta.events.register_first(
+            f"needs-retry.{service}",
+            functools.partial(after_attempt, account_id=account_id),
+            unique_id="rate-limiter-after-attempt",
+        )
+    return client
@@ -10,6 +10,16 @@ class RegionLookupError(Exception):
 
 
 def active_region():
+    region_name, _ = active_region_with_ttl()
+    return region_name
+
+
+def active_region_with_ttl():
+    """
+    Look up the active region of the AWS Health API.
+
+    :return: A tuple of the region name and the TTL of the DNS record in seconds.
+    """
     qname = "global.health.amazonaws.com"
     try:
         answers = dns.resolver.resolve(qname, "CNAME")
@@ -23,4 +33,4 @@ def active_region():
     region_name = name.split(".")[
         1
     ]  # Region name is the 1st in split('.') -> ['health', 'us-east-1', 'amazonaws', 'com', '']
-    return region_name
+    return region_name, answers.rrset.ttl
@@ -0,0 +1,234 @@
+import json
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter
+from datetime import datetime
+
+from checkpoint import CHECKPOINT_PREFIX
+from document_metadata import metadata_document
+from manifest import content_hash
+from partitions import partition_key
+from s3_uploader import read_state
+from serialization import document_upload_args, dumps, encode_body
+from storage import storage_sink
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+SUMMARIES_PREFIX = "summaries"
+
+
+def rollup_state_key(account_id, collector):
+    return f"{CHECKPOINT_PREFIX}/{account_id}/{collector}-rollup.json"
+
+
+def summary_key(document_prefix, account_id, month):
+    # e.g. summaries/support-cases/{account}/2024/07.json
+    return f"{SUMMARIES_PREFIX}/{document_prefix}/{account_id}/{month}.json"
+
+
+def month_of(value):
+    """Get the "YYYY/MM" month of a datetime or of an ISO 8601 string."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return f"{value.year}/{value.month:02d}"
+
+
+def format_counts(counts):
+    return ", ".join(f"{value} ({count})" for value, count in counts.items())
+
+
+class Rollup(ABC):
+    """
+    Summary of the documents of a collector per account and month, kept up
+    to date from the items seen by each run rather than by reading the
+    stored documents again.
+
+    The attributes of every document summarized, its facets, are stored per
+    account next to the checkpoint of the collector. A document seen again
+    replaces its facets, so a case changing status moves from one count to
+    the other, and only the summaries of the months with changed documents
+    are written again. The documents whose upload failed are left out until
+    a later run uploads them.
+
+    Subclasses set the collector, its documents and the facets counted, and
+    describe the items of the collector.
+
+    :param bucket_name: The S3 bucket holding the support data.
+    """
+
+    collector = None
+    document_prefix = None
+    label = None
+    facets = ()
+
+    def __init__(self, bucket_name):
+        self.bucket_name = bucket_name
+        self.__states = {}
+        self.__pending = {}
+        self.__touched = set()
+        self.__lock = threading.Lock()
+
+    @abstractmethod
+    def describe(self, item):
+        """
+        Describe an item of the collector.
+
+        :return: The account ID, document key, "YYYY/MM" month and facets of
+            the item, or None to leave it out of the summaries.
+        """
+
+    def record_key(self, file_key, _month):
+        """Get the key of the record of a document, the document key unless it is summarized in several months."""
+        return file_key
+
+    def is_uploaded(self, _facets):
+        """Whether the document of an item is uploaded, so only summarized once its upload succeeded."""
+        return True
+
+    def extra(self, _records):
+        """Get the collector specific fields of a summary."""
+        return {}
+
+    def account_state(self, account_id):
+        with self.__lock:
+            if account_id in self.__states:
+                return self.__states[account_id]
+        body = read_state(self.bucket_name, rollup_state_key(account_id, self.collector))
+        state = (
+            json.loads(body.decode("utf-8"))
+            if body is not None
+            else {"records": {}, "summaries": {}}
+        )
+        with self.__lock:
+            return self.__states.setdefault(account_id, state)
+
+    def observe(self, items):
+        """Note the facets of a stream of items as they are produced, until their upload report."""
+        for item in items:
+            description = self.describe(item)
+            if description is not None:
+                with self.__lock:
+                    self.__pending[description[1]] = description
+            yield item
+
+    def record(self, account_id, file_key, month, facets):
+        """Record the facets of a document, marking its month for an update."""
+        records = self.account_state(account_id)["records"]
+        record_key = self.record_key(file_key, month)
+        record = dict(facets, month=month)
+        previous = records.get(record_key)
+        if previous == record:
+            return
+        if previous is not None:
+            self.__touched.add((account_id, previous["month"]))
+        records[record_key] = record
+        self.__touched.add((account_id, month))
+
+    def commit(self, report):
+        """
+        Record the facets of the items whose document was uploaded, or is
+        unchanged, as a document or in its partition.
+        """
+        written = set(report["succeeded"]) | set(report["skipped"])
+        with self.__lock:
+            pending = list(self.__pending.values())
+            self.__pending.clear()
+        for account_id, file_key, month, facets in pending:
+            if (
+                not self.is_uploaded(facets)
+                or file_key in written
+                or partition_key(file_key) in written
+            ):
+                self.record(account_id, file_key, month, facets)
+
+    def summary(self, account_id, month, records):
+        summary = {
+            "account_id": account_id,
+            "collector": self.collector,
+            "month": month.replace("/", "-"),
+            "total": len(records),
+        }
+        for facet in self.facets:
+            counts = Counter(record.get(facet) or "unknown" for record in records)
+            summary[f"by_{facet}"] = dict(counts.most_common())
+        summary.update(self.extra(records))
+        summary["summary_context"] = (
+            f"This is the summary of the {len(records)} {self.label} of AWS account ID "
+            f"{account_id} for the month {summary['month']}. "
+            + " ".join(
+                f"By {facet}: {format_counts(summary[f'by_{facet}'])}."
+                for facet in self.facets
+            )
+        )
+        return summary
+
+    def write_summary(self, sink, account_id, month):
+        """
+        Write the summary of an account and month, with its metadata file,
+        if it changed since it was last written.
+
+        :return: True if the summary was written.
+        """
+        state = self.__states[account_id]
+        records = [
+            record for record in state["records"].values() if record["month"] == month
+        ]
+        key = summary_key(self.document_prefix, account_id, month)
+        body = dumps(self.summary(account_id, month, records))
+        if state["summaries"].get(month) == content_hash(body):
+            return False
+
+        metadata = metadata_document(
+            key,
+            f"Summary of the {self.label} of account {account_id} for {month.replace('/', '-')}",
+            {
+                "_category": "Monthly summary",
+                "_created_at": f"{month.replace('/', '-')}-01T00:00:00Z",
+                "account_id": account_id,
+                "category": self.label,
+            },
+        )
+        try:
+            for file_key, document_body in ((key, body), metadata):
+                sink.put(file_key, encode_body(document_body), document_upload_args())
+        except sink.errors as err:
+            logger.error("Couldn't write the summary %s: %s", key, err)
+            # Written again by the next run
+            state["summaries"][month] = None
+            return False
+        state["summaries"][month] = content_hash(body)
+        return True
+
+    def save(self, report):
+        """
+        Record the documents of the upload report, then write the summaries
+        of the months with changed documents, and of the months whose summary
+        failed to be written, and store the facets of their accounts.
+
+        :param report: The upload report of the documents observed.
+        :return: The number of summaries written.
+        """
+        self.commit(report)
+        sink = storage_sink(self.bucket_name)
+        months = set(self.__touched)
+        for account_id, state in self.__states.items():
+            months.update(
+                (account_id, month)
+                for month, digest in state["summaries"].items()
+                if digest is None
+            )
+
+        written = sum(
+            self.write_summary(sink, account_id, month)
+            for account_id, month in sorted(months)
+        )
+        for account_id in sorted({account_id for account_id, _ in months}):
+            sink.put(
+                rollup_state_key(account_id, self.collector),
+                json.dumps(self.__states[account_id]).encode("utf-8"),
+            )
+        self.__touched.clear()
+        print(f"Updated {written} monthly summaries of the {self.label}")
+        return written
@@ -0,0 +1,84 @@
+import logging
+from botocore.exceptions import ClientError
+
+from storage import BatchWriter, storage_sink
+from metrics import NO_METRICS
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DEFAULT_UPLOAD_CONCURRENCY = 10
+MAX_UPLOAD_CONCURRENCY = 50
+
+
+def get_upload_concurrency(value):
+    """
+    Normalize the upload concurrency coming from the scheduler event payload.
+
+    :param value: The requested number of concurrent uploads, or None.
+    :return: The concurrency to use, between 1 and MAX_UPLOAD_CONCURRENCY.
+    """
+    if value is None:
+        return DEFAULT_UPLOAD_CONCURRENCY
+    return max(1, min(int(value), MAX_UPLOAD_CONCURRENCY))
+
+
+def read_object(bucket_name, file_key):
+    """Read an object of the bucket, or return None if it doesn't exist."""
+    return storage_sink(bucket_name).get(file_key)
+
+
+def read_state(bucket_name, file_key):
+    """
+    Read an object the collectors keep their state in, such as a checkpoint,
+    or return None if it doesn't exist.
+
+    Without s3:ListBucket on the bucket, S3 answers AccessDenied instead of
+    NoSuchKey for a missing key, e.g. with the policy of a central bucket
+    created by an earlier version, so the state is read as missing then.
+    """
+    try:
+        return read_object(bucket_name, file_key)
+    except ClientError as err:
+        if err.response["Error"]["Code"] not in ("AccessDenied", "403"):
+            raise
+        logger.warning(
+            "Couldn't read %s, reading it as missing. Grant s3:ListBucket on the bucket "
+            "to tell missing objects apart: %s",
+            file_key,
+            err,
+        )
+        return None
+
+
+def upload_documents(
+    bucket_name,
+    documents,
+    concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+    extra_args=None,
+    *,
+    metrics=NO_METRICS,
+):
+    """
+    Upload documents to the storage of the bucket using a bounded pool of
+    workers.
+
+    The documents are consumed lazily and at most twice as many documents as
+    workers are buffered, so a generator fed by an API paginator is uploaded
+    while its next pages are fetched, with a flat memory footprint.
+
+    :param bucket_name: The S3 bucket name.
+    :param documents: An iterable of (file_key, body) tuples.
+    :param concurrency: The maximum number of uploads in flight.
+    :param extra_args: Additional put_object parameters for all the documents,
+        e.g. ContentType.
+    :param metrics: The CollectorMetrics recording the upload phase.
+    :return: A report with the succeeded and failed keys, in the order the
+        documents were given.
+    """
+    concurrency = get_upload_concurrency(concurrency)
+    sink = storage_sink(bucket_name, max_pool_connections=concurrency)
+    with BatchWriter(sink, concurrency, extra_args, metrics=metrics) as writer:
+        for file_key, body in documents:
+            writer.write(file_key, body)
+    return writer.report
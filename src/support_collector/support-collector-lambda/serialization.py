@@ -0,0 +1,101 @@
+import datetime
+import gzip
+import json
+import os
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# JSON formats of the documents: "standard" is the historical output of
+# json.dumps, byte for byte; "fast" is compact JSON, serialized with orjson
+# when it is installed and with the json module otherwise
+STANDARD = "standard"
+FAST = "fast"
+JSON_FORMATS = (STANDARD, FAST)
+
+# Content encodings of the documents uploaded one object per document
+IDENTITY = "identity"
+GZIP = "gzip"
+CONTENT_ENCODINGS = (IDENTITY, GZIP)
+
+GZIP_COMPRESS_LEVEL = 6
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def json_default(o):
+    """Serialize the values the json module doesn't handle, e.g. the Health API datetimes."""
+    if isinstance(o, (datetime.datetime, datetime.date)):
+        return o.isoformat()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def get_setting(name, default, choices):
+    value = os.environ.get(name, default).lower()
+    if value not in choices:
+        raise ValueError(f"{name} must be one of {', '.join(choices)}")
+    return value
+
+
+JSON_FORMAT = get_setting("DOCUMENT_JSON_FORMAT", STANDARD, JSON_FORMATS)
+CONTENT_ENCODING = get_setting("DOCUMENT_CONTENT_ENCODING", IDENTITY, CONTENT_ENCODINGS)
+
+# The encoders are created once: json.dumps builds a new encoder on each call
+# as soon as an option is given
+STANDARD_ENCODER = json.JSONEncoder(ensure_ascii=False, default=json_default)
+COMPACT_ENCODER = json.JSONEncoder(
+    ensure_ascii=False, separators=(",", ":"), default=json_default
+)
+
+
+def dumps(obj):
+    """
+    Serialize a document to UTF-8 JSON, in the format set by the
+    DOCUMENT_JSON_FORMAT environment variable of the function.
+
+    :param obj: The document, which may contain datetimes.
+    :return: The JSON body, as bytes.
+    """
+    if JSON_FORMAT == STANDARD:
+        return STANDARD_ENCODER.encode(obj).encode("utf-8")
+    if orjson is not None:
+        # orjson serializes the datetimes natively, in ISO 8601 like isoformat
+        return orjson.dumps(obj, default=json_default)
+    return COMPACT_ENCODER.encode(obj).encode("utf-8")
+
+
+def document_upload_args():
+    """Get the put_object parameters of the documents in their content encoding."""
+    if CONTENT_ENCODING == GZIP:
+        return {"ContentEncoding": "gzip", "ContentType": "application/json"}
+    return None
+
+
+def encode_body(body):
+    """Encode a serialized document in the content encoding of the uploads."""
+    if CONTENT_ENCODING == GZIP:
+        # Without a modification time, the same document always gives the same bytes
+        return gzip.compress(body, compresslevel=GZIP_COMPRESS_LEVEL, mtime=0)
+    return body
+
+
+def encode_documents(documents):
+    """Encode a stream of (file_key, body) documents for upload."""
+    for file_key, body in documents:
+        yield file_key, encode_body(body)
+
+
+def decode_body(body):
+    """Decode a document read from S3, whatever the encoding it was uploaded with."""
+    if body is not None and body.startswith(GZIP_MAGIC):
+        return gzip.decompress(body)
+    return body
+
+
+if JSON_FORMAT == FAST and orjson is None:
+    logger.info("orjson is not installed, the documents are serialized with json")
@@ -0,0 +1,188 @@
+import os
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from botocore.exceptions import BotoCoreError, ClientError
+
+from clients import DEFAULT_MAX_POOL_CONNECTIONS, AwsClients
+from metrics import NO_METRICS, UPLOAD, log_sampled, retry_attempts
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+MAX_WRITE_ATTEMPTS = 3
+
+# Directory the documents are written to instead of the S3 bucket, e.g. to
+# run the collectors offline
+LOCAL_STORAGE_DIR = os.environ.get("LOCAL_STORAGE_DIR")
+
+
+class S3Sink:
+    """
+    Storage of the support data in an S3 bucket.
+
+    :param bucket_name: The S3 bucket name.
+    :param max_pool_connections: The number of threads writing concurrently.
+    """
+
+    errors = (BotoCoreError, ClientError)
+
+    def __init__(self, bucket_name, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+        self.bucket_name = bucket_name
+        self.s3 = AwsClients.client("s3", max_pool_connections=max_pool_connections)
+
+    def get(self, key):
+        """Read an object, or return None if it doesn't exist."""
+        try:
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as err:
+            if err.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return response["Body"].read()
+
+    def put(self, key, body, extra_args=None):
+        """
+        Write an object.
+
+        :param extra_args: Additional put_object parameters, e.g. ContentType.
+        :return: The number of retries of the request.
+        """
+        response = self.s3.put_object(
+            Bucket=self.bucket_name, Key=key, Body=body, **(extra_args or {})
+        )
+        return retry_attempts(response)
+
+
+class LocalSink:
+    """
+    Storage of the support data in a local directory, one file per key. The
+    put_object parameters, such as the content encoding, are not kept: the
+    files hold the bodies as they would be uploaded.
+
+    :param root: The directory standing for the bucket.
+    """
+
+    errors = (OSError,)
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, body, _extra_args=None):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written next to its final path then renamed, so readers never see
+        # a partial file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            os.replace(temp_path, path)
+        except OSError:
+            os.unlink(temp_path)
+            raise
+        return 0
+
+
+def storage_sink(bucket_name, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+    """
+    Get the storage of the support data: the S3 bucket, or a directory named
+    after it under LOCAL_STORAGE_DIR when the environment variable is set.
+    """
+    if LOCAL_STORAGE_DIR:
+        return LocalSink(os.path.join(LOCAL_STORAGE_DIR, bucket_name))
+    return S3Sink(bucket_name, max_pool_connections)
+
+
+def write_with_retry(sink, file_key, body, extra_args=None, *, metrics=NO_METRICS):
+    """
+    Write a document to a sink, retrying with a backoff.
+
+    :return: None if the document was written, otherwise the error message.
+    """
+    for attempt in range(1, MAX_WRITE_ATTEMPTS + 1):
+        try:
+            with metrics.timer(UPLOAD, ApiCalls=1):
+                retries = sink.put(file_key, body, extra_args)
+            metrics.add(UPLOAD, Items=1, Bytes=len(body), Retries=attempt - 1 + retries)
+            log_sampled("Uploaded %s", file_key)
+            return None
+        except sink.errors as err:
+            if attempt == MAX_WRITE_ATTEMPTS:
+                logger.error("Couldn't upload %s: %s", file_key, err)
+                metrics.add(UPLOAD, Retries=attempt - 1, Failures=1)
+                return str(err)
+            time.sleep(2 ** (attempt - 1) * 0.1)
+    return None
+
+
+class BatchWriter:
+    """
+    Write documents to a sink from a bounded pool of workers.
+
+    The documents are buffered until they are written, at most twice as many
+    as workers: once the buffer is full, writing a document waits for the
+    oldest one. The outcome of each document is recorded in the report, in
+    the order the documents were written.
+
+    :param sink: The S3Sink or LocalSink to write to.
+    :param concurrency: The maximum number of writes in flight.
+    :param extra_args: Additional put_object parameters for all the documents.
+    :param metrics: The CollectorMetrics recording the upload phase.
+    """
+
+    def __init__(self, sink, concurrency, extra_args=None, *, metrics=NO_METRICS):
+        self.sink = sink
+        self.concurrency = concurrency
+        self.extra_args = extra_args
+        self.metrics = metrics
+        self.report = {"succeeded": [], "failed": []}
+        self.__in_flight = deque()
+        self.__executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, file_key, body):
+        if len(self.__in_flight) >= self.concurrency * 2:
+            self.__record(*self.__in_flight.popleft())
+        future = self.__executor.submit(
+            write_with_retry,
+            self.sink,
+            file_key,
+            body,
+            self.extra_args,
+            metrics=self.metrics,
+        )
+        self.__in_flight.append((file_key, future))
+
+    def flush(self):
+        """Wait for the documents in flight, recording their outcome."""
+        while self.__in_flight:
+            self.__record(*self.__in_flight.popleft())
+
+    def close(self):
+        self.flush()
+        self.__executor.shutdown()
+
+    def __record(self, file_key, future):
+        error = future.result()
+        if error is None:
+            self.report["succeeded"].append(file_key)
+        else:
+            self.report["failed"].append({"key": file_key, "error": error})
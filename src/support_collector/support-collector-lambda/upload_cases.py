@@ -1,49 +1,138 @@
-import json
 from datetime import datetime, timedelta, timezone
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import logging
-import boto3
-from botocore.exceptions import ClientError
-
+from botocore.exceptions import BotoCoreError, ClientError
+
+from backfill import Continuation
+from checkpoint import load_checkpoint
+from clients import AwsClients
+from communications import (
+    CommunicationThreads,
+    add_communication_history,
+    with_communication_history,
+)
+from document_metadata import metadata_document
+from manifest import DocumentManifest
+from metrics import DETAILS, NO_METRICS, CollectorMetrics, retry_attempts
+from partitions import DOCUMENTS, write_documents
+from rollups import Rollup, month_of
+from s3_uploader import DEFAULT_UPLOAD_CONCURRENCY
+from serialization import document_upload_args, dumps, encode_body
+from storage import storage_sink, write_with_retry
 from utils import convert_time_to_month_year
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-session = boto3.Session()
+# Cases fetched in parallel when processing a batch of Support Case Update events
+CASE_FETCH_CONCURRENCY = 5
 
-def save_to_s3(cases_by_account, bucket_name):
-    region = session.region_name
-    s3 = session.client("s3", region_name=region)
 
-    print(f"The Support cases are being uploaded to S3 bucket {bucket_name}...")
-    for account_id, cases in cases_by_account.items():
-        for case in cases:
-            # Extracting case ID for filename
-            case_id = case["case"]["displayId"]
+def case_file_key(account_id, case):
+    """Get the S3 key of a case dictionary."""
+    # Extracting case ID for filename
+    case_id = case["case"]["displayId"]
 
-            # Extracting creation time for partitioning in S3
-            time_created = case["case"]["timeCreated"]
-            # Convert the time_created in the format "2024-07-23T15:49:29.995Z" to "2024/07"
-            creation_date = convert_time_to_month_year(iso_datetime=time_created)
+    # Extracting creation time for partitioning in S3
+    time_created = case["case"]["timeCreated"]
+    # Convert the time_created in the format "2024-07-23T15:49:29.995Z" to "2024/07"
+    creation_date = convert_time_to_month_year(iso_datetime=time_created)
 
-            # Serialize case data to JSON with UTF-8 encoding
-            case_json = json.dumps(case, ensure_ascii=False).encode("utf-8")
+    return f"support-cases/{account_id}/{creation_date}/{case_id}.json"
 
-            file_key = f"support-cases/{account_id}/{creation_date}/{case_id}.json"
-            s3.put_object(Bucket=bucket_name, Key=file_key, Body=case_json)
 
-            print(f"Uploaded {file_key}")
-    print("Support cases upload done!")
+def case_document(account_id, case):
+    """Build the S3 key and the JSON body of a case dictionary."""
+    # Serialize case data to JSON with UTF-8 encoding
+    case_json = dumps(case)
 
+    return case_file_key(account_id, case), case_json
 
-def get_support_cases(credentials):
-    support_client = session.client(
-        "support",
-        aws_access_key_id=credentials["AccessKeyId"],
-        aws_secret_access_key=credentials["SecretAccessKey"],
-        aws_session_token=credentials["SessionToken"],
+
+def case_metadata_document(account_id, case_dict):
+    """Build the metadata file of a case dictionary, with the attributes to filter the cases on."""
+    case = case_dict["case"]
+    return metadata_document(
+        case_file_key(account_id, case_dict),
+        f"Support case {case['displayId']}: {case.get('subject', '')}",
+        {
+            "_category": "Support case",
+            "_created_at": case["timeCreated"],
+            "_last_updated_at": case_dict.get("latest_communication_time"),
+            "account_id": account_id,
+            "service": case.get("serviceCode"),
+            "severity": case.get("severityCode"),
+            "status": case.get("status"),
+            "category": case.get("categoryCode"),
+        },
+    )
+
+
+class CaseRollup(Rollup):
+    """Monthly summaries of the support cases, by the month they were opened."""
+
+    collector = "cases"
+    document_prefix = "support-cases"
+    label = "support cases"
+    facets = ("service", "severity", "status", "category")
+
+    def describe(self, item):
+        account_id, case_dict = item
+        case = case_dict["case"]
+        return (
+            account_id,
+            case_file_key(account_id, case_dict),
+            month_of(case["timeCreated"]),
+            {
+                "service": case.get("serviceCode"),
+                "severity": case.get("severityCode"),
+                "status": case.get("status"),
+                "category": case.get("categoryCode"),
+            },
+        )
+
+
+def save_to_s3(
+    cases_by_account,
+    bucket_name,
+    upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+    output_format=DOCUMENTS,
+    *,
+    manifest=None,
+    rollup=None,
+    metrics=NO_METRICS,
+):
+    # The cases of each account can be a generator, they are serialized and
+    # uploaded as they are produced
+    account_cases = (
+        (account_id, case)
+        for account_id, cases in cases_by_account.items()
+        for case in cases
+    )
+    if rollup is not None:
+        account_cases = rollup.observe(account_cases)
+    documents = metrics.serialize(
+        lambda account_case: case_document(*account_case),
+        account_cases,
+        lambda account_case: case_metadata_document(*account_case),
     )
+
+    print(f"The Support cases are being uploaded to S3 bucket {bucket_name}...")
+    report = write_documents(
+        bucket_name, documents, upload_concurrency, output_format, manifest, metrics=metrics
+    )
+    print(
+        f"Support cases upload done! {len(report['succeeded'])} uploaded, "
+        f"{len(report['failed'])} failed, {len(report['skipped'])} unchanged."
+    )
+    if rollup is not None:
+        rollup.save(report)
+    return report
+
+
+def get_support_cases(credentials):
+    support_client = AwsClients.client("support", credentials=credentials)
     cases = []
     paginator = support_client.get_paginator("describe_cases")
     for page in paginator.paginate():
@@ -51,28 +140,30 @@ def get_support_cases(credentials):
     return cases
 
 
-def describe_cases(after_time, include_resolved):
+def iter_cases(after_time, include_resolved, continuation=None):
     """
-    Describe support cases over a period of time, optionally filtering
-    by status.
+    Yield support cases page by page over a period of time, optionally
+    filtering by status.
 
     :param after_time: The start time to include for cases.
-    :param before_time: The end time to include for cases.
     :param include_resolved: True to include resolved cases in the results,
         otherwise results are open cases.
-    :return: The final status of the case.
+    :param continuation: The Continuation tracking the pagination of a
+        backfill, or None to list all the cases.
+    :return: A generator of the cases, fetching the next page on demand.
     """
-    cases = []
+    continuation = continuation or Continuation()
     try:
-        support_client = session.client("support")
+        support_client = AwsClients.client("support")
         paginator = support_client.get_paginator("describe_cases")
-        for page in paginator.paginate(
+        for page in continuation.pages(
+            paginator,
             afterTime=after_time,
             includeResolvedCases=include_resolved,
             includeCommunications=True,
             language="en",
         ):
-            cases += page["cases"]
+            yield from page["cases"]
     except ClientError as err:
         if err.response["Error"]["Code"] == "SubscriptionRequiredException":
             logger.info(
@@ -87,16 +178,35 @@ def describe_cases(after_time, include_resolved):
                 err.response["Error"]["Message"],
             )
             raise
-    return cases
 
 
-def list_all_cases(days):
+def describe_cases(after_time, include_resolved):
+    """
+    Describe support cases over a period of time, optionally filtering
+    by status.
+
+    :param after_time: The start time to include for cases.
+    :param include_resolved: True to include resolved cases in the results,
+        otherwise results are open cases.
+    :return: The list of cases.
+    """
+    return list(iter_cases(after_time, include_resolved))
+
+
+def cases_start_time(days, after_time=None):
+    if after_time is None:
+        start_date = datetime.now(timezone.utc).date() - timedelta(days)
+        return str(start_date)
+    return after_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def iter_all_cases(days, after_time=None):
     include_resolved = True
-    start_date = datetime.now(timezone.utc).date() - timedelta(days)
-    start_time = str(start_date)
-    all_cases = describe_cases(start_time, include_resolved)
+    return iter_cases(cases_start_time(days, after_time), include_resolved)
+
 
-    return all_cases
+def list_all_cases(days, after_time=None):
+    return list(iter_all_cases(days, after_time))
 
 
 def create_support_case_context(case, account_id):
@@ -112,55 +222,176 @@ def create_support_case_context(case, account_id):
     return support_case_context
 
 
-def upload_all_cases_to_s3(bucket_name, past_no_of_days, account_id):
-    cases_by_account = defaultdict(list)
-    cases = list_all_cases(past_no_of_days)
-
-    for case in cases:
-        case_dict = {
-            "account_id": account_id,
-            "case": case,
-            "support_case_context": create_support_case_context(
-                case, account_id
-            ),  # Add the custom field
-        }
-        cases_by_account[account_id].append(case_dict)
+def build_case_dict(case, account_id):
+    return {
+        "account_id": account_id,
+        "case": case,
+        "support_case_context": create_support_case_context(
+            case, account_id
+        ),  # Add the custom field
+    }
 
-    save_to_s3(cases_by_account, bucket_name)
 
-def upload_case_to_s3(bucket_name, account_id, case_id):
+def iter_case_dicts(bucket_name, account_id, cases, metrics=NO_METRICS, threads=None):
     """
-    Upload a single support case to S3
-    :param bucket_name: The S3 bucket name
-    :param account_id: AWS account ID
-    :param case_id: Support case display ID
+    Build the case dictionaries of a stream of cases, with the full
+    communication history of each case fetched concurrently.
+
+    :param threads: The CommunicationThreads of the run, or None to read the
+        stored document of each case.
     """
+    case_documents = (
+        (case_file_key(account_id, case_dict), case_dict)
+        for case_dict in (build_case_dict(case, account_id) for case in cases)
+    )
+    for _, case_dict in with_communication_history(
+        bucket_name, case_documents, metrics=metrics, threads=threads
+    ):
+        yield case_dict
+
+
+def upload_all_cases_to_s3(
+    bucket_name,
+    past_no_of_days,
+    account_id,
+    upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+    *,
+    incremental=True,
+    output_format=DOCUMENTS,
+    time_budget=None,
+    continuation_state=None,
+):
+    metrics = CollectorMetrics("cases", account_id)
+    continuation = Continuation(time_budget, continuation_state, metrics)
+    if continuation.window is None:
+        # Take the high-water mark before listing, so cases updated during the
+        # run are picked up again by the next one
+        continuation.high_water_mark = datetime.now(timezone.utc)
+        after_time = (
+            load_checkpoint(bucket_name, account_id, "cases") if incremental else None
+        )
+        continuation.window = {
+            "after_time": cases_start_time(past_no_of_days, after_time)
+        }
 
-    support_client = session.client("support")
+    # Stream the cases: each page is uploaded while the next ones are fetched
+    threads = CommunicationThreads(bucket_name, output_format)
+    cases = iter_case_dicts(
+        bucket_name,
+        account_id,
+        iter_cases(continuation.window["after_time"], True, continuation),
+        metrics,
+        threads,
+    )
 
-    # Get single case with displayId filter
-    case_response = support_client.describe_cases(
-        displayId=case_id,
-        includeCommunications=True,
-        language="en"
+    report = save_to_s3(
+        {account_id: cases},
+        bucket_name,
+        upload_concurrency,
+        output_format,
+        # Cases updated without any change to their document are not uploaded again
+        manifest=DocumentManifest(bucket_name, "cases", incremental),
+        rollup=CaseRollup(bucket_name),
+        metrics=metrics,
     )
+    threads.save(report)
+    metrics.emit()
+    return continuation.complete(report, bucket_name, account_id, "cases")
+
+
+def fetch_case(case_id, metrics=NO_METRICS):
+    """Describe a single support case, with its recent communications."""
+    support_client = AwsClients.client("support")
+
+    # Get single case with displayId filter
+    with metrics.timer(DETAILS, ApiCalls=1):
+        case_response = support_client.describe_cases(
+            displayId=case_id,
+            includeCommunications=True,
+            language="en"
+        )
+    metrics.add(DETAILS, Retries=retry_attempts(case_response))
 
     if not case_response['cases']:
         raise ValueError(f"No case found with display ID {case_id}")
 
-    case = case_response['cases'][0]
+    return case_response['cases'][0]
 
+
+def fetch_case_dict(bucket_name, account_id, case_id, metrics=NO_METRICS):
+    """Describe a single support case and build its dictionary with its full thread."""
+    case_dict = build_case_dict(fetch_case(case_id, metrics), account_id)
+    return add_communication_history(
+        bucket_name, case_file_key(account_id, case_dict), case_dict, metrics
+    )
+
+
+def upload_case_to_s3(bucket_name, account_id, case_id):
+    """
+    Upload a single support case to S3
+    :param bucket_name: The S3 bucket name
+    :param account_id: AWS account ID
+    :param case_id: Support case display ID
+    """
     # Create the case dictionary
     cases_by_account = defaultdict(list)
-    case_dict = {
-        "account_id": account_id,
-        "case": case,
-        "support_case_context": create_support_case_context(
-            case, account_id
-        )
-    }
-    cases_by_account[account_id].append(case_dict)
+    cases_by_account[account_id].append(
+        fetch_case_dict(bucket_name, account_id, case_id)
+    )
 
     # Save to S3
-    save_to_s3(cases_by_account, bucket_name)
-    
\ No newline at end of file
+    report = save_to_s3(cases_by_account, bucket_name)
+    if report["failed"]:
+        raise RuntimeError(f"Couldn't upload case {case_id}: {report['failed'][0]['error']}")
+    return report
+
+
+def upload_cases_by_id_to_s3(
+    bucket_name, account_id, case_ids, concurrency=CASE_FETCH_CONCURRENCY
+):
+    """
+    Fetch and upload several support cases concurrently.
+
+    :param bucket_name: The S3 bucket name
+    :param account_id: AWS account ID
+    :param case_ids: Distinct support case display IDs
+    :param concurrency: The maximum number of cases fetched and uploaded in parallel
+    :return: A dictionary of the error of each case keyed by display ID, the
+        error being None when the case was uploaded.
+    """
+    sink = storage_sink(bucket_name, max_pool_connections=concurrency)
+    metrics = CollectorMetrics("case-events", account_id)
+
+    def upload(case_id):
+        # A case failing, e.g. on a connection error or a malformed case, only
+        # fails the messages of this case
+        try:
+            case_dict = fetch_case_dict(bucket_name, account_id, case_id, metrics)
+            documents = list(
+                metrics.serialize(
+                    lambda case: case_document(account_id, case),
+                    [case_dict],
+                    lambda case: case_metadata_document(account_id, case),
+                )
+            )
+        except (BotoCoreError, ClientError, KeyError, ValueError) as err:
+            logger.error("Couldn't describe case %s: %s", case_id, err)
+            metrics.add(DETAILS, Failures=1)
+            return str(err)
+        # The case document, then its metadata file
+        errors = [
+            write_with_retry(
+                sink,
+                file_key,
+                encode_body(body),
+                document_upload_args(),
+                metrics=metrics,
+            )
+            for file_key, body in documents
+        ]
+        return next((error for error in errors if error), None)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        errors = dict(zip(case_ids, executor.map(upload, case_ids)))
+    metrics.emit()
+    return errors
@@ -1,111 +1,422 @@
-import json
 import datetime
-from collections import defaultdict
+import time
 import logging
-import boto3
 
+from backfill import Continuation
+from checkpoint import load_checkpoint
+from clients import AssumedRoles, ContextThreadPoolExecutor
+from health_client import HealthPaginator, call_health
+from document_metadata import metadata_document
+from manifest import DocumentManifest
+from member_accounts import member_role_arn
+from metrics import DETAILS, NO_METRICS, CollectorMetrics, retry_attempts
+from partitions import DOCUMENTS, write_documents
+from rollups import Rollup, month_of
+from s3_uploader import DEFAULT_UPLOAD_CONCURRENCY
+from serialization import dumps
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
-session = boto3.Session()
+# DescribeEventDetails accepts at most 10 event ARNs per call
+EVENT_DETAILS_BATCH_SIZE = 10
+EVENT_DETAILS_CONCURRENCY = 4
+MAX_EVENT_DETAILS_ATTEMPTS = 3
 
 
-class DatetimeEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, datetime.datetime):
-            return o.isoformat()
-        return super().default(o)
+def event_file_key(account_id, event):
+    """Get the S3 key of an event."""
+    # Clean ARN for use as filename
+    arn = event["arn"].split(":")[-1].replace("/", "_")
 
+    # Extracting start time for partitioning in S3
+    dt = event["startTime"]
+    start_date = f"{dt.year}/{dt.month}"
 
-def save_to_s3(events_by_account, bucket_name):
-    region = session.region_name
-    s3 = session.client("s3", region_name=region)
+    # Construct the file key using account_id, date, and arn
+    return f"health/{account_id}/{start_date}/{arn}.json"
 
-    print(f"The Health events are being uploaded to S3 bucket {bucket_name}...")
-    for account_id, account_events in events_by_account.items():
-        for event_dict in account_events:
-            event = event_dict["event"]
 
-            # Clean ARN for use as filename
-            arn = event["arn"].split(":")[-1].replace("/", "_")
-            event_json = json.dumps(
-                event, cls=DatetimeEncoder, ensure_ascii=False
-            ).encode("utf-8")
+def event_document(account_id, event_dict):
+    """Build the S3 key and the JSON body of an event dictionary."""
+    event = event_dict["event"]
+    # The datetimes of the event are serialized in ISO 8601
+    event_json = dumps(event)
+    return event_file_key(account_id, event), event_json
+
 
-            # Extracting start time for partitioning in S3
-            dt = event["startTime"]
-            start_date = f"{dt.year}/{dt.month}"
+def event_metadata_document(account_id, event_dict):
+    """Build the metadata file of an event dictionary, with the attributes to filter the events on."""
+    event = event_dict["event"]
+    return metadata_document(
+        event_file_key(account_id, event),
+        f"AWS Health event {event['eventTypeCode']} for {event['service']}",
+        {
+            "_category": "Health event",
+            "_created_at": event["startTime"],
+            "_last_updated_at": event.get("lastUpdatedTime"),
+            "account_id": account_id,
+            "service": event.get("service"),
+            "status": event.get("statusCode"),
+            "category": event.get("eventTypeCategory"),
+            "region": event.get("region"),
+        },
+    )
 
-            # Construct the file key using account_id, date, and arn
-            file_key = f"health/{account_id}/{start_date}/{arn}.json"
-            s3.put_object(Bucket=bucket_name, Key=file_key, Body=event_json)
 
-            print(f"Uploaded {file_key}")
-    print("Health upload done!")
+class EventRollup(Rollup):
+    """Monthly summaries of the Health events, by the month they started."""
 
+    collector = "health"
+    document_prefix = "health"
+    label = "AWS Health events"
+    facets = ("service", "category", "status", "region")
 
-def assume_role(account_id, role_name):
-    sts_client = session.client("sts")
-    response = sts_client.assume_role(
-        RoleArn=f"arn:aws:iam::{account_id}:role/{role_name}",
-        RoleSessionName="HealthEventSession",
+    def describe(self, item):
+        account_id = item["account_id"]
+        event = item["event"]
+        return (
+            account_id,
+            event_file_key(account_id, event),
+            month_of(event["startTime"]),
+            {
+                "service": event.get("service"),
+                "category": event.get("eventTypeCategory"),
+                "status": event.get("statusCode"),
+                "region": event.get("region"),
+            },
+        )
+
+
+def save_to_s3(
+    events_by_account,
+    bucket_name,
+    upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+    output_format=DOCUMENTS,
+):
+    # The events of each account can be a generator, they are serialized and
+    # uploaded as they are produced
+    event_dicts = (
+        event_dict
+        for account_events in events_by_account.values()
+        for event_dict in account_events
     )
-    return response["Credentials"]
+    return write_events(event_dicts, bucket_name, upload_concurrency, output_format)
+
 
+def write_events(
+    event_dicts,
+    bucket_name,
+    upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+    output_format=DOCUMENTS,
+    *,
+    manifest=None,
+    rollup=None,
+    metrics=NO_METRICS,
+):
+    """
+    Upload a stream of event dictionaries, each one under its own account.
 
-def list_health_events(past_no_of_days):
-    health_client = session.client(
-        "health",
-        region_name="us-east-1",  # AWS Health API must be called from us-east-1
+    The events whose details couldn't be fetched are written without them,
+    and reported as failed, so the checkpoint doesn't move past them and the
+    next run fetches their details again.
+    """
+    without_details = []
+
+    def track_details(event_dicts):
+        for event_dict in event_dicts:
+            if "details" not in event_dict["event"]:
+                without_details.append(
+                    event_file_key(event_dict["account_id"], event_dict["event"])
+                )
+            yield event_dict
+
+    event_dicts = track_details(event_dicts)
+    if rollup is not None:
+        event_dicts = rollup.observe(event_dicts)
+    documents = metrics.serialize(
+        lambda event_dict: event_document(event_dict["account_id"], event_dict),
+        event_dicts,
+        lambda event_dict: event_metadata_document(event_dict["account_id"], event_dict),
     )
-    health_events = []
-    events_paginator = health_client.get_paginator("describe_events")
 
-    # Describe events using the same default filters as the Personal Health Dashboard (PHD).
-    events_pages = events_paginator.paginate(
-        filter={
-            "startTimes": [
-                {
-                    "from": datetime.datetime.now()
-                    - datetime.timedelta(days=past_no_of_days)
-                },
-                {"to": datetime.datetime.now()},
-            ],
-            "eventStatusCodes": ["open", "upcoming", "closed"],
-        }
+    print(f"The Health events are being uploaded to S3 bucket {bucket_name}...")
+    report = write_documents(
+        bucket_name, documents, upload_concurrency, output_format, manifest, metrics=metrics
+    )
+    report["failed"].extend(
+        {"key": file_key, "error": "Couldn't describe the event details"}
+        for file_key in without_details
     )
+    print(
+        f"Health upload done! {len(report['succeeded'])} uploaded, "
+        f"{len(report['failed'])} failed, {len(report['skipped'])} unchanged."
+    )
+    if rollup is not None:
+        rollup.save(report)
+    return report
+
+
+def assume_role(account_id, role_name):
+    # The credentials are cached and refreshed before they expire
+    return AssumedRoles.credentials(member_role_arn(account_id, role_name))
+
+
+def event_detail_filter(event_arn, affected_accounts):
+    detail_filter = {"eventArn": event_arn}
+    if affected_accounts:
+        # The description of an event is the same for all the affected accounts
+        detail_filter["awsAccountId"] = affected_accounts[0]
+    return detail_filter
+
 
-    event_arns = []
-    for events_page in events_pages:
-        for event in events_page["events"]:
-            event_arns.append(event["arn"])
-            health_events.append(event)  # Collecting basic event data
-
-    # Fetching detailed information about each event in chunks of 10 - there is a limit of 10
-    while event_arns:
-        arns_chunk = event_arns[:10]
-        event_arns = event_arns[10:]
-        details_response = health_client.describe_event_details(eventArns=arns_chunk)
+def describe_event_details(event_arns, affected_accounts=None, metrics=NO_METRICS):
+    """
+    Fetch the latest description of up to 10 events, retrying the events
+    returned in the failedSet of the response.
+
+    :param event_arns: The ARNs of the events.
+    :param affected_accounts: The affected accounts keyed by event ARN to
+        describe the events from the organizational view, or None to
+        describe the events of the account.
+    :param metrics: The CollectorMetrics recording the details phase.
+    :return: A dictionary of the event descriptions keyed by event ARN.
+    """
+    details = {}
+    for attempt in range(1, MAX_EVENT_DETAILS_ATTEMPTS + 1):
+        with metrics.timer(DETAILS, ApiCalls=1):
+            if affected_accounts is None:
+                details_response = call_health(
+                    "describe_event_details", eventArns=event_arns
+                )
+            else:
+                details_response = call_health(
+                    "describe_event_details_for_organization",
+                    organizationEventDetailFilters=[
+                        event_detail_filter(arn, affected_accounts[arn])
+                        for arn in event_arns
+                    ]
+                )
+        metrics.add(
+            DETAILS,
+            Items=len(details_response["successfulSet"]),
+            Retries=retry_attempts(details_response),
+        )
         for detail in details_response["successfulSet"]:
-            # Update each event with its detailed description
-            for event in health_events:
-                if event["arn"] == detail["event"]["arn"]:
-                    event.update(
-                        {"details": detail["eventDescription"]["latestDescription"]}
-                    )
+            details[detail["event"]["arn"]] = detail["eventDescription"][
+                "latestDescription"
+            ]
+
+        event_arns = [
+            failed["eventArn"] for failed in details_response.get("failedSet", [])
+        ]
+        if not event_arns:
+            return details
+        if attempt < MAX_EVENT_DETAILS_ATTEMPTS:
+            time.sleep(2 ** (attempt - 1) * 0.5)
+
+    metrics.add(DETAILS, Failures=len(event_arns))
+    logging.warning(
+        "Couldn't describe the details of %d events: %s",
+        len(event_arns),
+        ", ".join(event_arns),
+    )
+    return details
 
-    return health_events
 
+def health_events_window(past_no_of_days, last_updated_after=None):
+    """Get the time window of the events to list, serializable in a continuation."""
+    if last_updated_after is None:
+        now = datetime.datetime.now()
+        return {
+            "field": "startTimes",
+            "from": (now - datetime.timedelta(days=past_no_of_days)).isoformat(),
+            "to": now.isoformat(),
+        }
+    # Incremental run: only the events updated since the last checkpoint
+    return {"field": "lastUpdatedTimes", "from": last_updated_after.isoformat()}
 
-def upload_health_events_to_s3(bucket_name, past_no_of_days, account_id):
-    org_client = session.client("organizations")
-    events_by_account = defaultdict(list)
 
-    events = list_health_events(past_no_of_days)
+def health_events_filter(window):
+    # Describe events using the same default filters as the Personal Health Dashboard (PHD).
+    time_range = [{"from": datetime.datetime.fromisoformat(window["from"])}]
+    if window.get("to"):
+        time_range.append({"to": datetime.datetime.fromisoformat(window["to"])})
+    return {
+        window["field"]: time_range,
+        "eventStatusCodes": ["open", "upcoming", "closed"],
+    }
 
-    for event in events:
-        event_dict = {"account_id": account_id, "event": event}
-        events_by_account[account_id].append(event_dict)
 
-    save_to_s3(events_by_account, bucket_name)
+def organization_events_filter(window):
+    # The organizational view takes a single time range per field
+    time_range = {"from": datetime.datetime.fromisoformat(window["from"])}
+    if window.get("to"):
+        time_range["to"] = datetime.datetime.fromisoformat(window["to"])
+    field = {"startTimes": "startTime", "lastUpdatedTimes": "lastUpdatedTime"}[
+        window["field"]
+    ]
+    return {field: time_range, "eventStatusCodes": ["open", "upcoming", "closed"]}
+
+
+def describe_affected_accounts(event_arn, metrics=NO_METRICS):
+    paginator = HealthPaginator("describe_affected_accounts_for_organization")
+    affected_accounts = []
+    pages = iter(paginator.paginate(eventArn=event_arn))
+    while True:
+        with metrics.timer(DETAILS):
+            page = next(pages, None)
+        if page is None:
+            return affected_accounts
+        metrics.add(DETAILS, ApiCalls=1, Retries=retry_attempts(page))
+        affected_accounts.extend(page["affectedAccounts"])
+
+
+def add_event_details(executor, health_events, affected_accounts=None, metrics=NO_METRICS):
+    """
+    Add the details of a page of events, fetched in concurrent chunks of 10.
+
+    :param health_events: The events of the page indexed by ARN, updated in place.
+    """
+    event_arns = list(health_events)
+    arns_chunks = [
+        event_arns[i : i + EVENT_DETAILS_BATCH_SIZE]
+        for i in range(0, len(event_arns), EVENT_DETAILS_BATCH_SIZE)
+    ]
+    for details in executor.map(
+        lambda arns_chunk: describe_event_details(
+            arns_chunk, affected_accounts, metrics
+        ),
+        arns_chunks,
+    ):
+        # Update each event with its detailed description
+        for arn, description in details.items():
+            health_events[arn]["details"] = description
+
+
+def iter_health_events(window, continuation=None):
+    """
+    Yield Health events with their details, page by page: the details of a
+    page are fetched before the next page is requested.
+
+    :param window: The time window returned by health_events_window.
+    :param continuation: The Continuation tracking the pagination of a
+        backfill, or None to list all the events.
+    """
+    continuation = continuation or Continuation()
+    # The Health API is called in its active region, following region switches
+    events_paginator = HealthPaginator("describe_events")
+    events_pages = continuation.pages(
+        events_paginator, filter=health_events_filter(window)
+    )
+
+    with ContextThreadPoolExecutor(max_workers=EVENT_DETAILS_CONCURRENCY) as executor:
+        for events_page in events_pages:
+            # Collecting basic event data, indexed by ARN to join the details
+            health_events = {event["arn"]: event for event in events_page["events"]}
+            add_event_details(executor, health_events, metrics=continuation.metrics)
+
+            yield from health_events.values()
+
+
+def iter_organization_health_events(window, account_id, continuation=None):
+    """
+    Yield the Health events of all the accounts of the organization, page by
+    page, from the organizational view of the management account. Each event
+    is listed and detailed once, then yielded for every affected account.
+
+    :param window: The time window returned by health_events_window.
+    :param account_id: The management account ID, under which the public
+        events, which have no affected accounts, are stored.
+    :param continuation: The Continuation tracking the pagination of a
+        backfill, or None to list all the events.
+    :return: A generator of the event dictionaries.
+    """
+    continuation = continuation or Continuation()
+    events_paginator = HealthPaginator("describe_events_for_organization")
+    events_pages = continuation.pages(
+        events_paginator, filter=organization_events_filter(window)
+    )
+
+    with ContextThreadPoolExecutor(max_workers=EVENT_DETAILS_CONCURRENCY) as executor:
+        for events_page in events_pages:
+            health_events = {event["arn"]: event for event in events_page["events"]}
+            affected_accounts = dict(
+                zip(
+                    health_events,
+                    executor.map(
+                        lambda arn: describe_affected_accounts(
+                            arn, continuation.metrics
+                        ),
+                        health_events,
+                    ),
+                )
+            )
+            add_event_details(
+                executor, health_events, affected_accounts, continuation.metrics
+            )
+
+            for arn, event in health_events.items():
+                for affected_account in affected_accounts[arn] or [account_id]:
+                    yield {"account_id": affected_account, "event": event}
+
+
+def list_health_events(past_no_of_days, last_updated_after=None):
+    return list(
+        iter_health_events(health_events_window(past_no_of_days, last_updated_after))
+    )
+
+
+def upload_health_events_to_s3(
+    bucket_name,
+    past_no_of_days,
+    account_id,
+    upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+    *,
+    incremental=True,
+    output_format=DOCUMENTS,
+    time_budget=None,
+    continuation_state=None,
+    organization=False,
+):
+    """
+    Upload the Health events of the account, or with organization set, the
+    events of all the accounts of the organization from the management account.
+    """
+    # The organizational view keeps its own checkpoint in the management account
+    collector = "organization-health" if organization else "health"
+    metrics = CollectorMetrics(collector, account_id)
+    continuation = Continuation(time_budget, continuation_state, metrics)
+    if continuation.window is None:
+        # Take the high-water mark before listing, so events updated during the
+        # run are picked up again by the next one
+        continuation.high_water_mark = datetime.datetime.now(datetime.timezone.utc)
+        last_updated_after = (
+            load_checkpoint(bucket_name, account_id, collector) if incremental else None
+        )
+        continuation.window = health_events_window(past_no_of_days, last_updated_after)
+
+    # Stream the events: each page is uploaded while the next ones are fetched
+    if organization:
+        events = iter_organization_health_events(
+            continuation.window, account_id, continuation
+        )
+    else:
+        events = (
+            {"account_id": account_id, "event": event}
+            for event in iter_health_events(continuation.window, continuation)
+        )
+
+    report = write_events(
+        events,
+        bucket_name,
+        upload_concurrency,
+        output_format,
+        manifest=DocumentManifest(bucket_name, collector, incremental),
+        # The events of an account are summarized together, whichever view
+        # collected them
+        rollup=EventRollup(bucket_name),
+        metrics=metrics,
+    )
+    metrics.emit()
+    return continuation.complete(report, bucket_name, account_id, collector)
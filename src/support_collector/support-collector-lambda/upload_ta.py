@@ -1,78 +1,292 @@
 import json
+import os
+import time
 from collections import defaultdict
-import boto3
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import logging
 
-session = boto3.Session()
+from clients import AwsClients
+from document_metadata import metadata_document
+from manifest import DocumentManifest
+from metrics import DETAILS, LIST, NO_METRICS, CollectorMetrics, log_sampled, retry_attempts
+from partitions import DOCUMENTS, write_documents
+from rollups import Rollup, month_of
+from s3_uploader import DEFAULT_UPLOAD_CONCURRENCY
+from serialization import dumps
 
-# Load trustedadvisorchecksinfo.json
-with open("ta_checks_info.json", "r", encoding="utf-8") as f:
-    checks_info = json.load(f)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
-# Create a dictionary for easy lookup
-checks_info_dict = {
-    check["checkId"]: {"name": check["name"], "description": check["description"]}
-    for check in checks_info
-}
+# The requests are sent within the Support API rate limits of rate_limiter
+TA_FETCH_CONCURRENCY = 8
 
+# Statuses of the check results uploaded as documents
+UPLOADED_STATUSES = ["warning", "error", "yellow", "red"]
 
-def save_to_s3(recommendations_by_account, bucket_name):
-    region = session.region_name
-    s3 = session.client("s3", region_name=region)
+# Checks listed per category in the monthly summaries, the most flagged first
+TOP_CHECKS_PER_CATEGORY = 5
 
+# Compact lookup of the check descriptions keyed by checkId, generated from
+# ta_checks_info.json by build_ta_checks_index.py
+TA_CHECKS_INDEX_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "ta_checks_index.json"
+)
+
+
+@lru_cache(maxsize=None)
+def load_check_descriptions():
+    # Loaded on first use only, to keep it out of the cold start of the other collectors
+    with open(TA_CHECKS_INDEX_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def get_check_description(check_id):
+    return load_check_descriptions().get(check_id, "No description provided")
+
+
+def save_to_s3(
+    recommendations_by_account,
+    bucket_name,
+    upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+    output_format=DOCUMENTS,
+    *,
+    checks=None,
+    manifest=None,
+    rollup=None,
+    metrics=NO_METRICS,
+):
     print(f"The TA recommendations are being uploaded to S3 bucket {bucket_name}...")
-    for account_id, recommendations in recommendations_by_account.items():
-        for recommendation in recommendations:
-            status = recommendation["recommendation"]["status"].lower()
-            # Filter for warning or error status
-            if status in [
-                "warning",
-                "error",
-                "yellow",
-                "red",
-            ]:
-                # Extract the checkId from the recommendation
-                check_id = recommendation["recommendation"]["checkId"]
-                # Get the description from the checks_info_dict
-                description = checks_info_dict.get(check_id, {}).get(
-                    "description", "No description provided"
-                )
-                # Update the recommendation with name and modified description
-                recommendation["recommendation"][
-                    "description"
-                ] = f"The Trusted Advisor (TA) recommendation is for AWS account Id {account_id} that has TA status as '{status}'. This status {status} indicates the account owner should take action on the resources stated here as per this recommendation. The recommendation is as follows: {description}"
-                recommendation_json = json.dumps(
-                    recommendation, ensure_ascii=False
-                ).encode("utf-8")
-                # Construct the file key using account_id, date, and checkId
-                file_key = f"ta/{account_id}/{check_id}.json"
-                s3.put_object(
-                    Bucket=bucket_name, Key=file_key, Body=recommendation_json
-                )
-                print(f"Uploaded {file_key}")
-    print("TA upload done!")
-
-
-def get_ta_recommendations():
-    support_client = session.client("support")
-    recommendations = []
+    checks = checks or {}
+    account_recommendations = (
+        (account_id, recommendation)
+        for account_id, recommendations in recommendations_by_account.items()
+        for recommendation in recommendations
+    )
+    # The summaries count the checks of every status
+    if rollup is not None:
+        account_recommendations = rollup.observe(account_recommendations)
+    # Filter for warning or error status
+    documents = metrics.serialize(
+        lambda account_recommendation: recommendation_document(*account_recommendation),
+        [
+            (account_id, recommendation)
+            for account_id, recommendation in account_recommendations
+            if recommendation["recommendation"]["status"].lower()
+            in UPLOADED_STATUSES
+        ],
+        lambda account_recommendation: recommendation_metadata_document(
+            *account_recommendation, checks
+        ),
+    )
+
+    report = write_documents(
+        bucket_name, documents, upload_concurrency, output_format, manifest, metrics=metrics
+    )
+    print(
+        f"TA upload done! {len(report['succeeded'])} uploaded, "
+        f"{len(report['failed'])} failed, {len(report['skipped'])} unchanged."
+    )
+    if rollup is not None:
+        rollup.save(report)
+    return report
+
+
+def recommendation_document(account_id, recommendation):
+    """Build the S3 key and the JSON body of a recommendation dictionary."""
+    status = recommendation["recommendation"]["status"].lower()
+    # Extract the checkId from the recommendation
+    check_id = recommendation["recommendation"]["checkId"]
+    # Get the description from the checks index
+    description = get_check_description(check_id)
+    # Update the recommendation with name and modified description
+    recommendation["recommendation"][
+        "description"
+    ] = f"The Trusted Advisor (TA) recommendation is for AWS account Id {account_id} that has TA status as '{status}'. This status {status} indicates the account owner should take action on the resources stated here as per this recommendation. The recommendation is as follows: {description}"
+    # The time of the last refresh of the check changes on every run, the
+    # document only changes with the result of the check
+    recommendation["recommendation"].pop("timestamp", None)
+    recommendation_json = dumps(recommendation)
+    return recommendation_file_key(account_id, check_id), recommendation_json
+
+
+def recommendation_file_key(account_id, check_id):
+    # Construct the file key using account_id and checkId
+    return f"ta/{account_id}/{check_id}.json"
+
+
+def recommendation_metadata_document(account_id, recommendation, checks):
+    """
+    Build the metadata file of a recommendation dictionary, with the
+    attributes to filter the recommendations on.
+
+    :param checks: The Trusted Advisor checks keyed by checkId, for the name
+        and category of the check.
+    """
+    result = recommendation["recommendation"]
+    check = checks.get(result["checkId"], {})
+    return metadata_document(
+        recommendation_file_key(account_id, result["checkId"]),
+        f"Trusted Advisor check {check.get('name', result['checkId'])}",
+        {
+            "_category": "Trusted Advisor check",
+            "account_id": account_id,
+            "status": result["status"],
+            "category": check.get("category"),
+        },
+    )
+
+
+class RecommendationRollup(Rollup):
+    """
+    Monthly summaries of the Trusted Advisor checks. The checks have no date
+    of their own: each month holds the latest result of every check in that
+    month, with the most flagged checks of each category. The results are
+    recorded per month, so the summaries of the past months are kept as they
+    were at the end of the month.
+
+    :param checks: The Trusted Advisor checks keyed by checkId, for the name
+        and category of the checks.
+    """
+
+    collector = "ta"
+    document_prefix = "ta"
+    label = "Trusted Advisor checks"
+    facets = ("status", "category")
+
+    def __init__(self, bucket_name, checks):
+        super().__init__(bucket_name)
+        self.checks = checks
+        self.month = month_of(datetime.now(timezone.utc))
+
+    def describe(self, item):
+        account_id, recommendation = item
+        result = recommendation["recommendation"]
+        check = self.checks.get(result["checkId"], {})
+        return (
+            account_id,
+            recommendation_file_key(account_id, result["checkId"]),
+            self.month,
+            {
+                "status": result["status"],
+                "category": check.get("category"),
+                "name": check.get("name", result["checkId"]),
+                "flagged": result.get("resourcesSummary", {}).get("resourcesFlagged", 0),
+            },
+        )
+
+    def record_key(self, file_key, month):
+        return f"{month}/{file_key}"
+
+    def is_uploaded(self, facets):
+        # The checks in other statuses are summarized without a document
+        return facets["status"].lower() in UPLOADED_STATUSES
+
+    def extra(self, records):
+        flagged_by_category = defaultdict(list)
+        for record in records:
+            if record["status"].lower() in UPLOADED_STATUSES:
+                flagged_by_category[record["category"] or "unknown"].append(record)
+        return {
+            "top_checks_by_category": {
+                category: [
+                    {
+                        "name": record["name"],
+                        "status": record["status"],
+                        "resources_flagged": record["flagged"],
+                    }
+                    for record in sorted(
+                        category_records, key=lambda record: (-record["flagged"], record["name"])
+                    )[:TOP_CHECKS_PER_CATEGORY]
+                ]
+                for category, category_records in sorted(flagged_by_category.items())
+            }
+        }
+
+
+def describe_check_result(support_client, check_id, metrics=NO_METRICS):
+    started = time.monotonic()
+    result = support_client.describe_trusted_advisor_check_result(
+        checkId=check_id, language="en"
+    )
+    latency = time.monotonic() - started
+    metrics.add(
+        DETAILS,
+        DurationMs=latency * 1000,
+        ApiCalls=1,
+        Items=1,
+        Retries=retry_attempts(result),
+    )
+    return result["result"], latency
+
+
+def fetch_ta_recommendations(concurrency=TA_FETCH_CONCURRENCY, metrics=NO_METRICS):
+    """
+    Fetch the result of every Trusted Advisor check concurrently, within the
+    Support API rate limit.
+
+    :param concurrency: The maximum number of check results fetched in parallel.
+    :param metrics: The CollectorMetrics recording the list and details phases.
+    :return: The check results, in the order of the checks, a dictionary of
+        the latency in seconds of each check keyed by checkId, and the checks
+        keyed by checkId.
+    """
+    support_client = AwsClients.client("support", max_pool_connections=concurrency)
 
     # Call describe_trusted_advisor_checks directly
-    checks = support_client.describe_trusted_advisor_checks(language="en")["checks"]
+    with metrics.timer(LIST, ApiCalls=1):
+        checks = support_client.describe_trusted_advisor_checks(language="en")["checks"]
+    metrics.add(LIST, Items=len(checks))
 
-    for check in checks:
-        result = support_client.describe_trusted_advisor_check_result(
-            checkId=check["id"], language="en"
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(
+            executor.map(
+                lambda check: describe_check_result(
+                    support_client, check["id"], metrics
+                ),
+                checks,
+            )
         )
-        recommendations.append(result["result"])
 
-    return recommendations
+    recommendations = [recommendation for recommendation, _ in results]
+    latencies = {
+        check["id"]: latency for check, (_, latency) in zip(checks, results)
+    }
+    return recommendations, latencies, {check["id"]: check for check in checks}
+
+
+def log_check_latencies(latencies):
+    for check_id, latency in latencies.items():
+        log_sampled("Fetched TA check %s in %.3fs", check_id, latency)
+    if latencies:
+        slowest = max(latencies, key=latencies.get)
+        print(
+            f"Fetched {len(latencies)} TA check results, average latency "
+            f"{sum(latencies.values()) / len(latencies):.3f}s, slowest {slowest} "
+            f"in {latencies[slowest]:.3f}s"
+        )
+
+
+def get_ta_recommendations(metrics=NO_METRICS):
+    recommendations, latencies, checks = fetch_ta_recommendations(metrics=metrics)
+    log_check_latencies(latencies)
+    return recommendations, checks
 
 
-def upload_all_recommendations_to_s3(bucket_name, account_id):
+def upload_all_recommendations_to_s3(
+    bucket_name,
+    account_id,
+    upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+    output_format=DOCUMENTS,
+    *,
+    incremental=True,
+):
 
+    metrics = CollectorMetrics("ta", account_id)
     recommendations_by_account = defaultdict(list)
 
-    recommendations = get_ta_recommendations()
+    recommendations, checks = get_ta_recommendations(metrics)
     print(f"Finding TA recommendations in {account_id}")
     for recommendation in recommendations:
         recommendation_dict = {
@@ -81,4 +295,16 @@ def upload_all_recommendations_to_s3(bucket_name, account_id):
         }
         recommendations_by_account[account_id].append(recommendation_dict)
 
-    save_to_s3(recommendations_by_account, bucket_name)
+    report = save_to_s3(
+        recommendations_by_account,
+        bucket_name,
+        upload_concurrency,
+        output_format=output_format,
+        checks=checks,
+        # Each run gets the result of every check, most of them unchanged
+        manifest=DocumentManifest(bucket_name, "ta", incremental),
+        rollup=RecommendationRollup(bucket_name, checks),
+        metrics=metrics,
+    )
+    metrics.emit()
+    return report